@@ -0,0 +1,178 @@
+import tensorflow as tf
+import numpy as np
+import subprocess
+import tempfile
+import shutil
+import random
+import os
+
+from pdf2image import convert_from_path
+
+from circuit_builder import Builder
+from images import IMAGE_SIZE
+
+DEFAULT_POOL_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '.cache', 'backgrounds.npy')
+
+# the resolution the corpus is rasterized at, so background text matches its scale
+DPI = 500
+
+
+def render_background_pool(num_pages=4, crops_per_page=16, seed=123):
+    """
+    Renders pages of random \\lipsum paragraphs once and crops windows of text from them,
+    the same text Builder(pad=True) surrounds circuits with.
+
+    :param num_pages: The number of pages to render.
+    :param crops_per_page: The number of windows to crop from each page.
+    :param seed: The seed of the paragraphs and the crops.
+    :raises: OSError
+    :return: The (num_pages * crops_per_page, height, width) uint8 crops.
+    """
+    if shutil.which('pdflatex') is None:
+        raise OSError('pdflatex is needed to render the background pool.')
+
+    rng = random.Random(seed)
+    crops = []
+    with tempfile.TemporaryDirectory() as folder:
+        for page in range(num_pages):
+            builder = Builder()
+            tex = '\\documentclass{article}\n\\usepackage{lipsum}\n\\begin{document}' + \
+                  ''.join(builder.tex_random_lipsum(rng) for _ in range(4)) + '\\end{document}\n'
+            with open(f'{folder}/background_{page}.tex', 'w') as f:
+                f.write(tex)
+            subprocess.run(['pdflatex', '-interaction=batchmode', f'background_{page}.tex'], cwd=folder,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            image = np.asarray(convert_from_path(f'{folder}/background_{page}.pdf', DPI)[0].convert('L'))
+            for _ in range(crops_per_page):
+                top = rng.randrange(image.shape[0] - IMAGE_SIZE[0])
+                left = rng.randrange(image.shape[1] - IMAGE_SIZE[1])
+                crops.append(image[top:top + IMAGE_SIZE[0], left:left + IMAGE_SIZE[1]])
+    return np.stack(crops)
+
+
+def background_pool(path=DEFAULT_POOL_PATH, **kwargs):
+    """
+    Loads the cached pool of background text crops, rendering it on first use.
+
+    :param path: The .npy file caching the pool.
+    :param kwargs: Passed on to render_background_pool.
+    :return: The pool, or None when it is not cached and cannot be rendered.
+    """
+    if os.path.exists(path):
+        return np.load(path)
+    try:
+        pool = render_background_pool(**kwargs)
+    except OSError as e:
+        print(f"Not compositing onto background text: {e}")
+        return None
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.save(path, pool)
+    return pool
+
+
+def jpeg_artifacts(image, min_quality=30, max_quality=95, probability=0.5):
+    """
+    Re-encodes an image as a jpeg of random quality. Encoding works on single images, so this
+    runs in the per-image map before batching.
+
+    :param image: The float (height, width, 3) image in [0, 255].
+    :param min_quality: The lowest jpeg quality.
+    :param max_quality: The highest jpeg quality.
+    :param probability: The chance of re-encoding the image.
+    :return: The image.
+    """
+    def encode():
+        quality = tf.random.uniform([], min_quality, max_quality + 1, dtype=tf.int32)
+        encoded = tf.image.adjust_jpeg_quality(tf.cast(image, tf.uint8), quality)
+        return tf.cast(encoded, tf.float32)
+
+    return tf.cond(tf.random.uniform([]) < probability, encode, lambda: tf.cast(image, tf.float32))
+
+
+def scale_and_shift(images, max_scale=0.15, max_shift=0.1):
+    """
+    Zooms and translates every image of a batch by its own random amount in a single
+    crop_and_resize, filling the uncovered border with white paper.
+
+    :param images: The float (batch, height, width, 3) images in [0, 255].
+    :param max_scale: The largest relative zoom in or out.
+    :param max_shift: The largest shift as a fraction of the image size.
+    :return: The images.
+    """
+    batch = tf.shape(images)[0]
+    # the box is the window of the image that fills the output, a bigger box zooms out
+    size = 1. / tf.random.uniform([batch], 1. - max_scale, 1. + max_scale)
+    center = 0.5 + tf.random.uniform([batch, 2], -max_shift, max_shift)
+    boxes = tf.stack([
+        center[:, 0] - size / 2,
+        center[:, 1] - size / 2,
+        center[:, 0] + size / 2,
+        center[:, 1] + size / 2
+    ], axis=1)
+    return tf.image.crop_and_resize(images, boxes, tf.range(batch), tf.shape(images)[1:3],
+                                    extrapolation_value=255.)
+
+
+def blur(images, max_sigma=1.5):
+    """
+    Blurs every image of a batch by its own random amount, blending each with one
+    Gaussian blur of the whole batch.
+
+    :param images: The float (batch, height, width, 3) images.
+    :param max_sigma: The sigma of the full blur.
+    :return: The images.
+    """
+    radius = int(np.ceil(2 * max_sigma))
+    taps = np.exp(-np.arange(-radius, radius + 1) ** 2 / (2 * max_sigma ** 2))
+    kernel = np.outer(taps, taps) / np.sum(np.outer(taps, taps))
+    kernel = tf.constant(np.tile(kernel[:, :, None, None], (1, 1, 3, 1)), dtype=images.dtype)
+    blurred = tf.nn.depthwise_conv2d(
+        tf.pad(images, [[0, 0], [radius, radius], [radius, radius], [0, 0]], mode='SYMMETRIC'),
+        kernel, strides=[1, 1, 1, 1], padding='VALID'
+    )
+    amount = tf.random.uniform([tf.shape(images)[0], 1, 1, 1], dtype=images.dtype)
+    return images + amount * (blurred - images)
+
+
+def composite(images, backgrounds, probability=0.5, margin=20):
+    """
+    Prints background text from the pool above and below the circuit in each image, like
+    the \\lipsum paragraphs of Builder(pad=True). The rows holding the circuit are found
+    from its dark pixels so the text never covers it.
+
+    :param images: The float (batch, height, width, 3) images in [0, 255].
+    :param backgrounds: The (pool, height, width) uint8 text crops.
+    :param probability: The chance of compositing each image.
+    :param margin: The blank rows kept around the circuit.
+    :return: The images.
+    """
+    batch = tf.shape(images)[0]
+    height = tf.shape(images)[1]
+    picks = tf.random.uniform([batch], 0, tf.shape(backgrounds)[0], dtype=tf.int32)
+    text = tf.cast(tf.gather(backgrounds, picks), images.dtype)[:, :, :, None]
+
+    dark_rows = tf.reduce_min(images, axis=[2, 3]) < 128.
+    rows = tf.range(height)[None, :]
+    first = tf.reduce_min(tf.where(dark_rows, rows, height), axis=1, keepdims=True)
+    last = tf.reduce_max(tf.where(dark_rows, rows, -1), axis=1, keepdims=True)
+    outside = (rows < first - margin) | (rows > last + margin)
+    chosen = tf.random.uniform([batch, 1]) < probability
+    mask = tf.cast(outside & chosen, images.dtype)[:, :, None, None]
+
+    # multiplying keeps ink from both, as printing the text on the same page would
+    return images * (1. - mask + mask * text / 255.)
+
+
+def augment_batch(images, backgrounds=None):
+    """
+    Applies the random scale, shift, blur and background compositing to a batch.
+
+    :param images: The float (batch, height, width, 3) images in [0, 255].
+    :param backgrounds: The pool of background text crops, or None to skip compositing.
+    :return: The images.
+    """
+    if backgrounds is not None:
+        images = composite(images, backgrounds)
+    images = scale_and_shift(images)
+    images = blur(images)
+    return tf.clip_by_value(images, 0., 255.)
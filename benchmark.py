@@ -0,0 +1,413 @@
+import numpy as np
+import contextlib
+import subprocess
+import platform
+import tempfile
+import pathlib
+import getopt
+import random
+import shutil
+import json
+import time
+import sys
+import os
+import io
+
+from qcircuit_parse import parse_circuit, ParseStats, Gate, GATES
+from circuit_builder import Builder
+from test_data_generation import enumerate_circuits, build_tex, build_qasm, render_circuit
+from tex_parse import find_qcircuits, tex_to_builder
+
+STAGES = [
+    'builder',
+    'enumeration',
+    'render',
+    'parse',
+    'tex_parse',
+    'input_pipeline',
+    'inference'
+]
+
+HELP_STRING = "Usage: python benchmark.py [--stages builder,enumeration,render,parse,tex_parse,input_pipeline,inference] " \
+              "[--output benchmark.json] [--seed 123] [--data_dir examples/gen] [--model_file model.tflite]"
+
+
+def summarize(times):
+    """
+    Summarizes a list of timings in seconds.
+
+    :param times: The timings.
+    :return: A dict of statistics in milliseconds.
+    """
+    times = np.array(times) * 1000
+    return {
+        'runs': len(times),
+        'mean_ms': float(np.mean(times)),
+        'p50_ms': float(np.percentile(times, 50)),
+        'p95_ms': float(np.percentile(times, 95)),
+        'min_ms': float(np.min(times))
+    }
+
+
+def random_circuit(qubits, depth, rng):
+    """
+    Builds a random circuit grid of supported gates with nearest-neighbour CNOTs.
+
+    :param qubits: The number of wires.
+    :param depth: The number of columns.
+    :param rng: The random.Random to draw from.
+    :return: The circuit as a list of wires, each a list of Gates.
+    """
+    single_qubit_gates = [gate for gate in GATES if gate != 'cx']
+    circuit = [[Gate(name=rng.choice(single_qubit_gates), index=i) for i in range(depth)] for wire in range(qubits)]
+    for i in range(depth):
+        wire = 0
+        while wire < qubits - 1:
+            if rng.random() < 0.3:
+                source, target = (wire, wire + 1) if rng.random() < 0.5 else (wire + 1, wire)
+                cnot = Gate(name='cx', source=source, target=target, index=i, source_index=i)
+                circuit[wire][i] = cnot
+                circuit[wire + 1][i] = cnot
+                wire += 1
+            wire += 1
+    return circuit
+
+
+def bench_builder(seed=123, num_gates=10000):
+    """
+    Times the Builder on a seeded random stream of gates.
+    """
+    rng = random.Random(seed)
+    qubits = 8
+    single_qubit_gates = [gate for gate in GATES if gate not in ['cx', 'I']]
+    ops = []
+    for _ in range(num_gates):
+        if rng.random() < 0.2:
+            source = rng.randrange(qubits - 1)
+            ops.append(('cx', source, source + 1))
+        else:
+            ops.append((rng.choice(single_qubit_gates), rng.randrange(qubits)))
+
+    builder = Builder(num_qubits=qubits)
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for op in ops:
+            getattr(builder, op[0])(*op[1:])
+        program = builder.program
+        elapsed = time.perf_counter() - start
+
+    return {
+        'gates': num_gates,
+        'seconds': elapsed,
+        'gates_per_sec': num_gates / elapsed,
+        'qasm_bytes': len(program)
+    }
+
+
+def bench_enumeration(max_circuit_depth=4, qubits=2):
+    """
+    Times the enumeration of circuits and their LaTeX and QASM construction.
+    """
+    start = time.perf_counter()
+    circuits = enumerate_circuits(max_circuit_depth, qubits)
+    enumerated = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for circuit in circuits:
+            builder = Builder(pad=False)
+            build_tex(circuit, builder)
+            build_qasm(circuit, builder)
+    built = time.perf_counter()
+
+    return {
+        'circuits': len(circuits),
+        'enumerate_seconds': enumerated - start,
+        'build_seconds': built - enumerated,
+        'circuits_per_sec': len(circuits) / (built - start)
+    }
+
+
+def render_random_circuits(shapes, folder, seed=123, per_shape=3):
+    """
+    Renders seeded random circuits of every shape to pdfs with pdflatex.
+
+    :param shapes: The (qubits, depth) pairs to render.
+    :param folder: The folder to render into.
+    :param seed: The seed of the circuits.
+    :param per_shape: The number of circuits of each shape.
+    :return: A dict of shape to the list of (pdf path, render seconds).
+    """
+    rng = random.Random(seed)
+    rendered = {}
+    num = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for shape in shapes:
+            rendered[shape] = []
+            for _ in range(per_shape):
+                builder = build_tex(random_circuit(shape[0], shape[1], rng), Builder(pad=False))
+                builder.print_tex_file(f"{folder}/circuit_{num}.tex")
+                start = time.perf_counter()
+                subprocess.run(['pdflatex', '-interaction=batchmode', f'circuit_{num}.tex'], cwd=folder,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                rendered[shape].append((f"{folder}/circuit_{num}.pdf", time.perf_counter() - start))
+                num += 1
+    return rendered
+
+
+def bench_render(seed=123, num_circuits=5):
+    """
+    Times pdflatex and rasterization of generated circuits through render_circuit.
+    """
+    if shutil.which('pdflatex') is None:
+        return {'skipped': 'pdflatex is not installed'}
+
+    circuits = enumerate_circuits(3, 2)
+    rng = random.Random(seed)
+    times = []
+    with tempfile.TemporaryDirectory() as folder:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for num in rng.sample(range(len(circuits)), num_circuits):
+                builder = Builder(pad=False)
+                build_tex(circuits[num], builder)
+                build_qasm(circuits[num], builder)
+                start = time.perf_counter()
+                render_circuit(builder, num, folder)
+                times.append(time.perf_counter() - start)
+
+    return summarize(times)
+
+
+def bench_parse(seed=123, data_dir='examples/gen', repeat=3):
+    """
+    Times parse_circuit against circuit width and depth.
+
+    Random circuits of increasing size are rendered when pdflatex is available,
+    otherwise the generated corpus is sampled by depth.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        if shutil.which('pdflatex') is not None:
+            shapes = [(2, 2), (2, 4), (2, 8), (4, 4), (4, 8), (8, 8)]
+            pdfs = {shape: [pdf for pdf, _ in rendered]
+                    for shape, rendered in render_random_circuits(shapes, folder, seed).items()}
+        else:
+            circuits = enumerate_circuits(4, 2)
+            rng = random.Random(seed)
+            pdfs = {}
+            for depth in [2, 3]:
+                ids = [num for num, circuit in enumerate(circuits) if len(circuit[0]) == depth]
+                pdfs[(2, depth)] = [f"{data_dir}/circuit_{num}.pdf" for num in rng.sample(ids, 3)]
+
+        for (qubits, depth), paths in pdfs.items():
+            times = []
+            failures = 0
+            stats = ParseStats()
+            for path in paths:
+                if not os.path.exists(path):
+                    continue
+                for _ in range(repeat):
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        start = time.perf_counter()
+                        try:
+                            parse_circuit(path, f"{folder}/readable.xml", stats=stats)
+                        except Exception:
+                            failures += 1
+                        times.append(time.perf_counter() - start)
+            if len(times) > 0:
+                results[f'{qubits}x{depth}'] = summarize(times)
+                results[f'{qubits}x{depth}']['failures'] = failures
+                if stats.files > 0:
+                    results[f'{qubits}x{depth}']['stages_ms'] = {
+                        stage: 1000 * getattr(stats, f'{stage}_time') / stats.files
+                        for stage in ['load', 'dump', 'walk', 'delegation']
+                    }
+                    results[f'{qubits}x{depth}']['element_counts'] = stats.element_counts
+
+    return results
+
+
+def bench_tex_parse(seed=123, per_shape=20):
+    """
+    Times reading the LaTeX of seeded random circuits straight to QASM, against circuit width and depth.
+    """
+    rng = random.Random(seed)
+    results = {}
+    for qubits, depth in [(2, 2), (2, 4), (2, 8), (4, 4), (4, 8), (8, 8), (16, 32)]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            texs = [build_tex(random_circuit(qubits, depth, rng), Builder(pad=False)).tex for _ in range(per_shape)]
+            times = []
+            for tex in texs:
+                start = time.perf_counter()
+                tex_to_builder(find_qcircuits(tex)[0])
+                times.append(time.perf_counter() - start)
+        results[f'{qubits}x{depth}'] = summarize(times)
+    return results
+
+
+def bench_input_pipeline(data_dir='examples/gen', batch_size=32, num_batches=20):
+    """
+    Measures the images/sec of the training input pipeline on a cold and a warm pass.
+    """
+    from image_classification import load_datasets
+
+    train_ds, val_ds, class_names, num_train = load_datasets(data_dir, batch_size)
+    results = {}
+    for name in ['cold', 'warm']:
+        images = 0
+        start = time.perf_counter()
+        for batch, labels in train_ds.take(num_batches):
+            images += int(batch.shape[0])
+        results[f'{name}_images_per_sec'] = images / (time.perf_counter() - start)
+    return results
+
+
+def bench_inference(data_dir='examples/gen', model_file='model.tflite', seed=123, repeat=20, batch_size=16):
+    """
+    Times tool.py style single image and batched inference with the TFLite model.
+    """
+    if not os.path.exists(model_file):
+        return {'skipped': f'{model_file} does not exist'}
+
+    import tensorflow as tf
+    from tool import get_saved_model, preprocess_image
+    from tflite_export import prepare_input
+
+    images = sorted(str(path) for path in pathlib.Path(data_dir).glob('*/*.jpg'))
+    images = random.Random(seed).sample(images, min(batch_size, len(images)))
+
+    start = time.perf_counter()
+    model = get_saved_model(model_file)
+    load_time = time.perf_counter() - start
+
+    input_name = list(model.get_input_details().keys())[0]
+    details = model.get_input_details()[input_name]
+
+    preprocess_times = []
+    single_times = []
+    for k in range(repeat):
+        start = time.perf_counter()
+        img = prepare_input(details, preprocess_image(images[k % len(images)]))
+        preprocess_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        model(**{input_name: img})
+        single_times.append(time.perf_counter() - start)
+
+    interpreter = tf.lite.Interpreter(model_path=model_file)
+    input_details = interpreter.get_input_details()[0]
+    batch = np.concatenate([prepare_input(input_details, preprocess_image(image)) for image in images])
+    interpreter.resize_tensor_input(input_details['index'], batch.shape)
+    interpreter.allocate_tensors()
+    batched_times = []
+    for _ in range(max(1, repeat // 4)):
+        start = time.perf_counter()
+        interpreter.set_tensor(input_details['index'], batch)
+        interpreter.invoke()
+        batched_times.append(time.perf_counter() - start)
+
+    batched = summarize(batched_times)
+    batched['per_image_ms'] = batched['mean_ms'] / len(batch)
+    return {
+        'load_ms': load_time * 1000,
+        'preprocess': summarize(preprocess_times),
+        'single': summarize(single_times),
+        f'batch_{len(batch)}': batched
+    }
+
+
+def git_commit():
+    """
+    Returns the commit being benchmarked, if the working directory is a git repository.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(stages=None, seed=123, data_dir='examples/gen', model_file='model.tflite'):
+    """
+    Runs the requested benchmark stages.
+
+    :param stages: The stages to run, defaults to all STAGES.
+    :param seed: The seed of every synthetic input.
+    :param data_dir: The generated corpus.
+    :param model_file: The TFLite model for the inference stage.
+    :raises: ValueError
+    :return: The results with metadata about the run.
+    """
+    stages = stages or STAGES
+    for stage in stages:
+        if stage not in STAGES:
+            raise ValueError(f'Unknown stage {stage}, expected one of {STAGES}.')
+
+    results = {}
+    for stage in stages:
+        print(f"benchmarking {stage}...")
+        if stage == 'builder':
+            results[stage] = bench_builder(seed)
+        elif stage == 'enumeration':
+            results[stage] = bench_enumeration()
+        elif stage == 'render':
+            results[stage] = bench_render(seed)
+        elif stage == 'parse':
+            results[stage] = bench_parse(seed, data_dir)
+        elif stage == 'tex_parse':
+            results[stage] = bench_tex_parse(seed)
+        elif stage == 'input_pipeline':
+            results[stage] = bench_input_pipeline(data_dir)
+        elif stage == 'inference':
+            results[stage] = bench_inference(data_dir, model_file, seed)
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'seed': seed
+        },
+        'results': results
+    }
+
+
+def main(argv):
+    stages = None
+    output = 'benchmark.json'
+    seed = 123
+    data_dir = 'examples/gen'
+    model_file = 'model.tflite'
+
+    try:
+        opts, args = getopt.getopt(
+            argv,
+            "h",
+            ["help", "stages=", "output=", "seed=", "data_dir=", "model_file="]
+        )
+    except getopt.GetoptError:
+        print(HELP_STRING)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ["-h", "--help"]:
+            print(HELP_STRING)
+            sys.exit()
+        elif opt == "--stages":
+            stages = arg.split(',')
+        elif opt == "--output":
+            output = arg
+        elif opt == "--seed":
+            seed = int(arg)
+        elif opt == "--data_dir":
+            data_dir = arg
+        elif opt == "--model_file":
+            model_file = arg
+
+    report = run(stages, seed, data_dir, model_file)
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report['results'], indent=2))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,403 @@
+import tensorflow as tf
+import numpy as np
+import contextlib
+import pathlib
+import hashlib
+import getopt
+import random
+import json
+import time
+import sys
+import io
+import os
+
+from itertools import permutations
+from functools import lru_cache
+
+from tensorflow.keras import layers
+from tensorflow.keras.models import Model
+
+from circuit_builder import Builder
+from images import load_image
+from test_data_generation import SINGLE_QUBIT_GATES, build_qasm, circuit_at, circuit_from_structure, \
+    circuit_structure
+
+# the structure model only has to tell CNOT layouts apart, which survive a 4x downscale
+STRUCTURE_SIZE = (100, 150)
+
+# the heads read the gate labels, which need more pixels
+HEAD_SIZE = (200, 300)
+
+DEFAULT_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cascade')
+
+HELP_STRING = "Usage: python cascade_model.py [--data_dir examples/gen] [--epochs 10] [--batch_size 32] " \
+              "[--max_depth 4] [--qubits 2] [--folder cascade] [--max_images 200]"
+
+
+def load_examples(data_dir='examples/gen', max_circuit_depth=4, qubits=2, validation_split=0.2, seed=123):
+    """
+    Labels every image of a generated corpus with the structural bucket of its circuit, its depth
+    and CNOT layout, and with the single qubit gates filling the rest of the grid.
+
+    :param data_dir: The folder holding the N/ image folders, N being the circuit id.
+    :param max_circuit_depth: The max depth the corpus was enumerated with.
+    :param qubits: The number of qubits the corpus was enumerated with.
+    :param validation_split: The fraction of images held out for validation.
+    :param seed: The seed of the train/validation shuffle.
+    :return: The training and validation examples as (path, bucket, gate ids) and the buckets,
+        each a dict of depth, combination, orientation and number of free cells.
+    """
+    buckets = []
+    ids = {}
+    examples = []
+    for folder in sorted(path for path in pathlib.Path(data_dir).iterdir() if path.is_dir() and path.name.isdigit()):
+        circuit_depth, _, combination, orientation, gates = circuit_structure(
+            circuit_at(int(folder.name), max_circuit_depth, qubits)
+        )
+        if (circuit_depth, combination, orientation) not in ids:
+            ids[(circuit_depth, combination, orientation)] = len(buckets)
+            buckets.append({
+                'depth': circuit_depth,
+                'combination': list(combination),
+                'orientation': list(orientation),
+                'free': len(gates)
+            })
+        bucket = ids[(circuit_depth, combination, orientation)]
+        gate_ids = tuple(SINGLE_QUBIT_GATES.index(gate) for gate in gates)
+        for image in sorted(folder.glob('*.jpg')):
+            examples.append((str(image), bucket, gate_ids))
+
+    random.Random(seed).shuffle(examples)
+    split = int(len(examples) * (1 - validation_split))
+    return examples[:split], examples[split:], buckets
+
+
+def drop_untrained_buckets(train_examples, val_examples, buckets):
+    """
+    Drops the buckets no training image fell into, as neither the structure model nor a head
+    can learn them, and renumbers the rest.
+
+    :param train_examples: The training (path, bucket, gate ids).
+    :param val_examples: The validation (path, bucket, gate ids).
+    :param buckets: The buckets from load_examples.
+    :return: The relabelled training and validation examples and the kept buckets. Validation
+        images of a dropped bucket are labelled -1, which no prediction matches.
+    """
+    kept = sorted(set(bucket for path, bucket, gates in train_examples))
+    ids = {bucket: i for i, bucket in enumerate(kept)}
+
+    def relabel(examples):
+        return [(path, ids.get(bucket, -1), gates) for path, bucket, gates in examples]
+
+    return relabel(train_examples), relabel(val_examples), [buckets[bucket] for bucket in kept]
+
+
+def downscale(image, size):
+    """
+    Shrinks an image or batch by averaging pixels, which keeps thin wires visible.
+    """
+    return tf.image.resize(image, size=size, method='area')
+
+
+def make_dataset(paths, labels, size, batch_size=32):
+    """
+    Batches images downscaled to the given size with their labels.
+    """
+    return tf.data.Dataset.from_tensor_slices((paths, labels)) \
+        .map(lambda path, label: (downscale(load_image(path), size), label), num_parallel_calls=tf.data.AUTOTUNE) \
+        .batch(batch_size) \
+        .prefetch(tf.data.AUTOTUNE)
+
+
+def build_structure_model(num_buckets):
+    """
+    Builds the first stage, a tiny model picking the structural bucket from a downscaled image.
+
+    The features are flattened rather than pooled globally, as where the CNOTs sit is the answer.
+
+    :param num_buckets: The number of buckets.
+    :return: The uncompiled model.
+    """
+    image = layers.Input(shape=STRUCTURE_SIZE + (3,), name='image')
+    x = layers.Rescaling(1./255)(image)
+    x = layers.Conv2D(8, 3, strides=2, padding='same', activation='relu')(x)
+    x = layers.Conv2D(16, 3, strides=2, padding='same', activation='relu')(x)
+    x = layers.MaxPooling2D(4)(x)
+    x = layers.Flatten()(x)
+    bucket = layers.Dense(num_buckets, name='bucket')(x)
+    return Model(inputs=image, outputs=bucket)
+
+
+def build_head_model(free_cells):
+    """
+    Builds the second stage for one bucket, predicting the gate in each of its free cells.
+
+    :param free_cells: The number of cells holding single qubit gates.
+    :return: The uncompiled model.
+    """
+    image = layers.Input(shape=HEAD_SIZE + (3,), name='image')
+    x = layers.Rescaling(1./255)(image)
+    x = layers.Conv2D(16, 3, strides=2, padding='same', activation='relu')(x)
+    x = layers.Conv2D(32, 3, strides=2, padding='same', activation='relu')(x)
+    x = layers.Conv2D(32, 3, strides=2, padding='same', activation='relu')(x)
+    x = layers.MaxPooling2D()(x)
+    x = layers.Flatten()(x)
+    x = layers.Dense(free_cells * len(SINGLE_QUBIT_GATES))(x)
+    gates = layers.Reshape((free_cells, len(SINGLE_QUBIT_GATES)), name='gates')(x)
+    return Model(inputs=image, outputs=gates)
+
+
+def _fit_and_convert(model, train_ds, epochs, path):
+    """
+    Trains a stage and writes it as a TFLite flatbuffer.
+    """
+    model.compile(
+        optimizer='adam',
+        loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+        metrics=['accuracy']
+    )
+    model.fit(train_ds, epochs=epochs, verbose=2)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    with open(path, 'wb') as f:
+        f.write(converter.convert())
+
+
+@lru_cache(maxsize=None)
+def _assignments(free_cells):
+    """
+    Lists every way to fill the free cells with distinct gates, in enumeration order.
+    """
+    return np.array(list(permutations(range(len(SINGLE_QUBIT_GATES)), free_cells)), dtype=np.int64) \
+        .reshape(-1, free_cells)
+
+
+def best_assignment(logits):
+    """
+    Scores every assignment of distinct gates to the free cells and picks the most likely one,
+    so the prediction is always a circuit of the enumeration.
+
+    :param logits: The (free cells, gates) logits of a head.
+    :return: The gate ids and the probability of the assignment among all valid ones.
+    """
+    shifted = logits - np.max(logits, axis=1, keepdims=True)
+    log_probs = shifted - np.log(np.sum(np.exp(shifted), axis=1, keepdims=True))
+    assignments = _assignments(len(logits))
+    scores = np.sum(log_probs[np.arange(len(logits)), assignments], axis=1)
+    best = int(np.argmax(scores))
+    probability = 1. / np.sum(np.exp(scores - scores[best]))
+    return assignments[best], float(probability)
+
+
+class Cascade(object):
+    """
+    Runs the structure model and then only the head of the bucket it picked. Heads are loaded
+    on first use, so a process only pays for the buckets it sees.
+    """
+
+    def __init__(self, folder=DEFAULT_FOLDER):
+        """
+        :param folder: The folder written by train_cascade.
+        """
+        self.folder = folder
+        with open(os.path.join(folder, 'cascade.json'), 'r') as f:
+            self.config = json.load(f)
+        self.structure = self._load('structure.tflite')
+        self.heads = {}
+
+    def _load(self, name):
+        interpreter = tf.lite.Interpreter(model_path=os.path.join(self.folder, name))
+        return interpreter.get_signature_runner('serving_default')
+
+    def head(self, bucket):
+        if bucket not in self.heads:
+            self.heads[bucket] = self._load(self.config['buckets'][bucket]['model'])
+        return self.heads[bucket]
+
+    def predict(self, image):
+        """
+        Classifies one circuit.
+
+        :param image: The float image batch of one, from images.load_image.
+        :return: A dict of the QASM, bucket, gate ids, confidence and milliseconds spent in each stage.
+        """
+        start = time.perf_counter()
+        logits = list(self.structure(image=downscale(image, STRUCTURE_SIZE).numpy()).values())[0][0]
+        bucket = int(np.argmax(logits))
+        confidence = float(tf.nn.softmax(logits)[bucket])
+        structure_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        layout = self.config['buckets'][bucket]
+        gates = np.zeros(0, dtype=np.int64)
+        if layout['free'] > 0 and layout['model'] is None:
+            # a cascade trained before empty buckets were dropped has no head for them
+            gates = _assignments(layout['free'])[0]
+            confidence = 0.
+        elif layout['free'] > 0:
+            logits = list(self.head(bucket)(image=downscale(image, HEAD_SIZE).numpy()).values())[0][0]
+            gates, probability = best_assignment(logits)
+            confidence *= probability
+        head_time = time.perf_counter() - start
+
+        circuit = circuit_from_structure(layout['depth'], self.config['qubits'], layout['combination'],
+                                         layout['orientation'], [SINGLE_QUBIT_GATES[gate] for gate in gates])
+        builder = Builder(num_qubits=len(circuit))
+        with contextlib.redirect_stdout(io.StringIO()):
+            build_qasm(circuit, builder)
+        return {
+            'qasm': builder.program,
+            'bucket': bucket,
+            'gates': [int(gate) for gate in gates],
+            'confidence': confidence,
+            'structure_ms': 1000 * structure_time,
+            'head_ms': 1000 * head_time
+        }
+
+
+def evaluate_cascade(cascade, examples, max_images=200):
+    """
+    Measures the accuracy and latency of each stage on held out images.
+
+    The head accuracy only counts images whose bucket was right, as a wrong bucket sends the
+    image to a head that cannot be right.
+
+    :param cascade: The Cascade.
+    :param examples: The (path, bucket, gate ids) to evaluate on.
+    :param max_images: The maximum number of images to evaluate.
+    :return: A dict of metrics per stage.
+    """
+    structure_times = []
+    head_times = []
+    structure_correct = 0
+    head_correct = 0
+    for path, bucket, gates in examples[:max_images]:
+        prediction = cascade.predict(load_image(path)[None, :, :])
+        structure_times.append(prediction['structure_ms'])
+        head_times.append(prediction['head_ms'])
+        if prediction['bucket'] == bucket:
+            structure_correct += 1
+            head_correct += tuple(prediction['gates']) == tuple(gates)
+
+    def stage(times, correct, total):
+        return {
+            'images': total,
+            'accuracy': correct / total if total else None,
+            'latency_ms_mean': float(np.mean(times)) if len(times) else None,
+            'latency_ms_p50': float(np.percentile(times, 50)) if len(times) else None,
+            'latency_ms_p95': float(np.percentile(times, 95)) if len(times) else None
+        }
+
+    images = len(structure_times)
+    return {
+        'structure': stage(structure_times, structure_correct, images),
+        'head': stage(head_times, head_correct, structure_correct),
+        'cascade': stage(np.add(structure_times, head_times), head_correct, images)
+    }
+
+
+def train_cascade(data_dir='examples/gen', epochs=10, batch_size=32, max_circuit_depth=4, qubits=2,
+                  folder=DEFAULT_FOLDER, max_images=200):
+    """
+    Trains the structure model and one head per bucket, writes them as TFLite models with a
+    cascade.json describing the buckets, and reports per stage accuracy and latency.
+
+    :param data_dir: The folder holding the N/ image folders.
+    :param epochs: The number of epochs to train every stage for.
+    :param batch_size: The batch size.
+    :param max_circuit_depth: The max depth the corpus was enumerated with.
+    :param qubits: The number of qubits the corpus was enumerated with.
+    :param folder: The folder to write the models to.
+    :param max_images: The maximum number of validation images to report on.
+    :return: The report.
+    """
+    train_examples, val_examples, buckets = load_examples(data_dir, max_circuit_depth, qubits)
+    num_buckets = len(buckets)
+    train_examples, val_examples, buckets = drop_untrained_buckets(train_examples, val_examples, buckets)
+    if len(buckets) < num_buckets:
+        print(f"Dropped {num_buckets - len(buckets)} buckets without training images")
+    os.makedirs(folder, exist_ok=True)
+
+    print(f"Training the structure model on {len(buckets)} buckets")
+    paths = [path for path, bucket, gates in train_examples]
+    labels = [bucket for path, bucket, gates in train_examples]
+    _fit_and_convert(build_structure_model(len(buckets)),
+                     make_dataset(paths, labels, STRUCTURE_SIZE, batch_size), epochs,
+                     os.path.join(folder, 'structure.tflite'))
+
+    for b, layout in enumerate(buckets):
+        layout['model'] = None
+        examples = [(path, gates) for path, bucket, gates in train_examples if bucket == b]
+        if layout['free'] == 0:
+            continue
+        print(f"Training the head of bucket {b} on {len(examples)} images")
+        layout['model'] = f'bucket_{b}.tflite'
+        _fit_and_convert(build_head_model(layout['free']),
+                         make_dataset([path for path, gates in examples], [list(gates) for path, gates in examples],
+                                      HEAD_SIZE, batch_size), epochs,
+                         os.path.join(folder, layout['model']))
+
+    # the digests version the cascade as a whole for the result cache
+    digests = {}
+    for name in ['structure.tflite'] + [layout['model'] for layout in buckets if layout['model'] is not None]:
+        with open(os.path.join(folder, name), 'rb') as f:
+            digests[name] = hashlib.sha256(f.read()).hexdigest()
+    with open(os.path.join(folder, 'cascade.json'), 'w') as f:
+        json.dump({
+            'qubits': qubits,
+            'max_circuit_depth': max_circuit_depth,
+            'buckets': buckets,
+            'digests': digests
+        }, f, indent=2)
+
+    report = evaluate_cascade(Cascade(folder), val_examples, max_images)
+    print(f"\n{'stage':<12}{'accuracy':>10}{'latency (ms)':>16}")
+    for name, metrics in report.items():
+        print(f"{name:<12}{metrics['accuracy'] or 0:>10.3f}{metrics['latency_ms_mean'] or 0:>16.2f}")
+    with open(os.path.join(folder, 'cascade_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def main(argv):
+    data_dir = 'examples/gen'
+    epochs = 10
+    batch_size = 32
+    max_depth = 4
+    qubits = 2
+    folder = DEFAULT_FOLDER
+    max_images = 200
+
+    try:
+        opts, args = getopt.getopt(
+            argv,
+            "h",
+            ["help", "data_dir=", "epochs=", "batch_size=", "max_depth=", "qubits=", "folder=", "max_images="]
+        )
+    except getopt.GetoptError:
+        print(HELP_STRING)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ["-h", "--help"]:
+            print(HELP_STRING)
+            sys.exit()
+        elif opt == "--data_dir":
+            data_dir = arg
+        elif opt == "--epochs":
+            epochs = int(arg)
+        elif opt == "--batch_size":
+            batch_size = int(arg)
+        elif opt == "--max_depth":
+            max_depth = int(arg)
+        elif opt == "--qubits":
+            qubits = int(arg)
+        elif opt == "--folder":
+            folder = arg
+        elif opt == "--max_images":
+            max_images = int(arg)
+
+    train_cascade(data_dir, epochs, batch_size, max_depth, qubits, folder, max_images)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
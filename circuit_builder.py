@@ -221,12 +221,13 @@ class Builder:
             self.tex_circuit += ' & \\gate{S^\\dagger}'
         return self
 
-    def tex_random_lipsum(self):
+    def tex_random_lipsum(self, rng=random):
         """
         Returns a random paragraph of text in LaTeX.
+        :param rng: The source of randomness, a random.Random or the random module.
         :return: the command for a random paragraph of text.
         """
-        n = random.randint(1, 50)
+        n = rng.randint(1, 50)
         return f'\n\\lipsum[{n}-{n}]\n'
 
     def tex_cx_source(self,  direction):
@@ -0,0 +1,272 @@
+import tensorflow as tf
+import numpy as np
+import pathlib
+import getopt
+import random
+import sys
+import re
+
+from tensorflow.keras import layers
+from tensorflow.keras.models import Model
+
+from qcircuit_parse import Gate, GATES
+from circuit_builder import Builder
+from test_data_generation import build_qasm
+from images import IMAGE_SIZE, load_image
+
+# every cell of the circuit grid holds one of these tokens, the CNOT is split
+# into its control (pointing at the target wire) and its target
+CELL_TOKENS = [gate for gate in GATES if gate != 'cx'] + [
+    'ctrl_up',
+    'ctrl_down',
+    'targ',
+    'pad'
+]
+
+TEX_CELLS = {
+    '\\gate{X}': 'x',
+    '\\gate{Y}': 'y',
+    '\\gate{Z}': 'z',
+    '\\gate{S}': 's',
+    '\\gate{S^\\dagger}': 'sdg',
+    '\\gate{H}': 'h',
+    '\\qw': 'I',
+    '\\ctrl{1}': 'ctrl_up',
+    '\\ctrl{-1}': 'ctrl_down',
+    '\\targ': 'targ'
+}
+
+HELP_STRING = "Usage: python grid_model.py [--data_dir examples/gen] [--epochs 10] " \
+              "[--max_qubits 2] [--max_depth 3]"
+
+
+def read_tex_grid(path_to_tex):
+    """
+    Reads the grid of cell tokens from a generated qcircuit LaTeX file.
+
+    :param path_to_tex: The path to the circuit_N.tex file.
+    :return: The grid as a list of wires, each a list of cell tokens.
+    """
+    with open(path_to_tex, 'r') as f:
+        tex = f.read()
+
+    body = re.search(r'\\Qcircuit[^{]*{(.*?)\n}', tex, re.DOTALL).group(1)
+
+    grid = []
+    for row in body.split('\\\\'):
+        cells = [cell.strip() for cell in row.split('&')][1:]
+        if len(cells) > 0:
+            grid.append([TEX_CELLS[cell] for cell in cells])
+    return grid
+
+
+def encode_grid(grid, max_qubits=2, max_depth=3):
+    """
+    Encodes a grid of cell tokens as a fixed size array of token ids.
+
+    :param grid: The grid as a list of wires, each a list of cell tokens.
+    :param max_qubits: The number of wires the model predicts.
+    :param max_depth: The number of columns the model predicts.
+    :raises: ValueError
+    :return: The (max_qubits, max_depth) array of token ids.
+    """
+    if len(grid) > max_qubits or max(len(wire) for wire in grid) > max_depth:
+        raise ValueError(f'The circuit does not fit in a {max_qubits}x{max_depth} grid.')
+
+    labels = np.full((max_qubits, max_depth), CELL_TOKENS.index('pad'), dtype=np.int32)
+    for w, wire in enumerate(grid):
+        for i, token in enumerate(wire):
+            labels[w, i] = CELL_TOKENS.index(token)
+    return labels
+
+
+def decode_grid(labels):
+    """
+    Decodes an array of token ids into a circuit of Gates.
+
+    Padding trims the circuit and controls without a matching target (or
+    targets without a matching control) are read as identities.
+
+    :param labels: The (qubits, depth) array of token ids.
+    :return: The circuit as a list of wires, each a list of Gates.
+    """
+    tokens = [[CELL_TOKENS[int(label)] for label in wire] for wire in labels]
+
+    qubits = 0
+    depth = 0
+    for w, wire in enumerate(tokens):
+        for i, token in enumerate(wire):
+            if token != 'pad':
+                qubits = max(qubits, w + 1)
+                depth = max(depth, i + 1)
+
+    circuit = [[Gate(name='I', index=i) for i in range(depth)] for wire in range(qubits)]
+    for w in range(qubits):
+        for i in range(depth):
+            token = tokens[w][i]
+            if token in ['ctrl_up', 'ctrl_down']:
+                target = w + 1 if token == 'ctrl_up' else w - 1
+                if 0 <= target < qubits and tokens[target][i] == 'targ':
+                    cnot = Gate(name='cx', source=w, target=target, index=i, source_index=i)
+                    circuit[w][i] = cnot
+                    circuit[target][i] = cnot
+            elif token not in ['targ', 'pad']:
+                circuit[w][i] = Gate(name=token, index=i)
+    return circuit
+
+
+def grid_to_qasm(labels):
+    """
+    Decodes an array of token ids to QASM through the Builder.
+
+    :param labels: The (qubits, depth) array of token ids.
+    :return: The QASM.
+    """
+    circuit = decode_grid(labels)
+    builder = Builder(num_qubits=len(circuit))
+    build_qasm(circuit, builder)
+    return builder.program
+
+
+def load_grid_datasets(data_dir='examples/gen', max_qubits=2, max_depth=3, batch_size=32,
+                       validation_split=0.2, seed=123):
+    """
+    Pairs the images of every generated circuit with its encoded grid.
+
+    :param data_dir: The folder holding circuit_N.tex files and N/ image folders.
+    :param max_qubits: The number of wires the model predicts.
+    :param max_depth: The number of columns the model predicts.
+    :param batch_size: The batch size.
+    :param validation_split: The fraction of images held out for validation.
+    :param seed: The seed of the train/validation shuffle.
+    :return: The training and validation datasets.
+    """
+    data_dir = pathlib.Path(data_dir)
+    paths = []
+    labels = []
+    for folder in sorted(path for path in data_dir.iterdir() if path.is_dir()):
+        tex = data_dir / f'circuit_{folder.name}.tex'
+        if not tex.exists():
+            continue
+        grid = encode_grid(read_tex_grid(tex), max_qubits, max_depth)
+        for image in sorted(folder.glob('*.jpg')):
+            paths.append(str(image))
+            labels.append(grid)
+
+    order = list(range(len(paths)))
+    random.Random(seed).shuffle(order)
+    paths = [paths[i] for i in order]
+    labels = np.stack([labels[i] for i in order])
+    split = int(len(paths) * (1 - validation_split))
+
+    def load(image_path, label):
+        return load_image(image_path), label
+
+    def dataset(start, stop):
+        return tf.data.Dataset.from_tensor_slices((paths[start:stop], labels[start:stop])) \
+            .map(load, num_parallel_calls=tf.data.AUTOTUNE) \
+            .batch(batch_size)
+
+    return dataset(0, split), dataset(split, len(paths))
+
+
+def build_grid_model(max_qubits=2, max_depth=3):
+    """
+    Builds a model predicting a gate token for every wire and column of the circuit.
+
+    The head is sized by the grid rather than by the number of circuits enumerated.
+
+    :param max_qubits: The number of wires the model predicts.
+    :param max_depth: The number of columns the model predicts.
+    :return: The uncompiled model.
+    """
+    image = layers.Input(shape=IMAGE_SIZE + (3,), name='image')
+    x = layers.Rescaling(1./255)(image)
+    x = layers.Conv2D(16, 3, padding='same', activation='relu')(x)
+    x = layers.MaxPooling2D()(x)
+    x = layers.Conv2D(32, 3, padding='same', activation='relu')(x)
+    x = layers.MaxPooling2D()(x)
+    x = layers.Conv2D(64, 3, padding='same', activation='relu')(x)
+    x = layers.MaxPooling2D()(x)
+    # shrink the feature map further but flatten it rather than pooling it globally, so each
+    # cell's token is read from features that still know where in the image they came from
+    x = layers.Conv2D(64, 3, strides=2, padding='same', activation='relu')(x)
+    x = layers.Conv2D(64, 3, strides=2, padding='same', activation='relu')(x)
+    x = layers.MaxPooling2D()(x)
+    x = layers.Flatten()(x)
+    x = layers.Dense(128, activation='relu')(x)
+    x = layers.Dense(max_qubits * max_depth * len(CELL_TOKENS))(x)
+    grid = layers.Reshape((max_qubits, max_depth, len(CELL_TOKENS)), name='grid')(x)
+    return Model(inputs=image, outputs=grid)
+
+
+def circuit_accuracy(labels, logits):
+    """
+    The fraction of circuits whose every cell was predicted correctly.
+    """
+    predicted = tf.cast(tf.argmax(logits, axis=-1), labels.dtype)
+    return tf.reduce_mean(tf.cast(tf.reduce_all(tf.equal(labels, predicted), axis=[1, 2]), tf.float32))
+
+
+def predict_qasm(classify_lite, image):
+    """
+    Runs a converted grid model on an image batch and decodes the first result to QASM.
+
+    :param classify_lite: The signature runner of the TFLite grid model.
+    :param image: The image batch.
+    :return: The QASM.
+    """
+    logits = list(classify_lite(image=image).values())[0]
+    return grid_to_qasm(np.argmax(logits[0], axis=-1))
+
+
+def main(argv):
+    data_dir = 'examples/gen'
+    epochs = 10
+    max_qubits = 2
+    max_depth = 3
+
+    try:
+        opts, args = getopt.getopt(
+            argv,
+            "h",
+            ["help", "data_dir=", "epochs=", "max_qubits=", "max_depth="]
+        )
+    except getopt.GetoptError:
+        print(HELP_STRING)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ["-h", "--help"]:
+            print(HELP_STRING)
+            sys.exit()
+        elif opt == "--data_dir":
+            data_dir = arg
+        elif opt == "--epochs":
+            epochs = int(arg)
+        elif opt == "--max_qubits":
+            max_qubits = int(arg)
+        elif opt == "--max_depth":
+            max_depth = int(arg)
+
+    train_ds, val_ds = load_grid_datasets(data_dir, max_qubits, max_depth)
+
+    model = build_grid_model(max_qubits, max_depth)
+    model.compile(
+        optimizer='adam',
+        loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+        metrics=['accuracy', circuit_accuracy]
+    )
+    model.summary()
+
+    model.fit(train_ds, validation_data=val_ds, epochs=epochs)
+
+    tf.saved_model.save(model, 'saved_models/grid_model')
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    with open('grid_model.tflite', 'wb') as f:
+        f.write(converter.convert())
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,115 +1,461 @@
+import matplotlib
 import matplotlib.pyplot as plt
-import PIL
 import tensorflow as tf
+import collections
 import pathlib
+import random
+import getopt
+import json
+import time
+import sys
+import os
 
 from tensorflow.keras import layers
 from tensorflow.keras.models import Sequential
 
-data_dir = pathlib.Path('./examples/gen')
-
-image_count = len(list(data_dir.glob('*/*.jpg')))
-print(image_count)
-
-circuits = list(data_dir.glob('*/*.jpg'))
-PIL.Image.open(str(circuits[0]))
-
-# Training split
-train_ds = tf.keras.utils.image_dataset_from_directory(
-    data_dir,
-    validation_split=0.2,
-    subset="training",
-    seed=123,
-    image_size=(400, 600),
-    batch_size=32
-)
-
-# Testing or Validation split
-val_ds = tf.keras.utils.image_dataset_from_directory(
-    data_dir,
-    validation_split=0.2,
-    subset="validation",
-    seed=123,
-    image_size=(400, 600),
-    batch_size=32
-)
-
-class_names = train_ds.class_names
-
-plt.figure(figsize=(50, 50))
-for images, labels in train_ds.take(1):
-  for i in range(9):
-    ax = plt.subplot(3, 3, i + 1)
-    plt.imshow(images[i].numpy().astype("uint8"))
-    plt.axis("off")
-
-plt.show()
-
-class_names = train_ds.class_names
-print(class_names)
-
-num_classes = len(class_names)
-
-# TODO: solve for model that is well suited to learning quantum circuits
-
-model = Sequential([
-    layers.Rescaling(1./255, input_shape=(400, 600, 3)),
-    layers.Conv2D(16, 3, padding='same', activation='relu'),
-    layers.MaxPooling2D(),
-    layers.Conv2D(32, 3, padding='same', activation='relu'),
-    layers.MaxPooling2D(),
-    layers.Conv2D(64, 3, padding='same', activation='relu'),
-    layers.MaxPooling2D(),
-    layers.Flatten(),
-    layers.Dense(128, activation='relu'),
-    layers.Dense(num_classes)
-])
-
-model.compile(
-    optimizer='adam',
-    loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
-    metrics=['accuracy']
-)
-model.summary()
-
-epochs = 10
-history = model.fit(
-    train_ds,
-    validation_data=val_ds,
-    epochs=epochs
-)
-
-#Accuracy
-acc = history.history['accuracy']
-val_acc = history.history['val_accuracy']
-
-#loss
-loss = history.history['loss']
-val_loss = history.history['val_loss']
-
-#epochs
-epochs_range = range(epochs)
-
-#Plotting graphs
-plt.figure(figsize=(8, 8))
-plt.subplot(1, 2, 1)
-plt.plot(epochs_range, acc, label='Training Accuracy')
-plt.plot(epochs_range, val_acc, label='Validation Accuracy')
-plt.legend(loc='lower right')
-plt.title('Training and Validation Accuracy')
-
-plt.subplot(1, 2, 2)
-plt.plot(epochs_range, loss, label='Training Loss')
-plt.plot(epochs_range, val_loss, label='Validation Loss')
-plt.legend(loc='upper right')
-plt.title('Training and Validation Loss')
-plt.show()
-
-tf.saved_model.save(model, f'saved_models/trained_model')
-
-# convert the model
-converter = tf.lite.TFLiteConverter.from_keras_model(model)
-tflite_model = converter.convert()
-# save the model
-with open('model.tflite', 'wb') as f:
-    f.write(tflite_model)
+from tflite_export import export_report
+from augmentation import augment_batch, background_pool, jpeg_artifacts
+from images import IMAGE_SIZE, decode_image
+
+HELP_STRING = "Usage: python image_classification.py [--data_dir examples/gen] [--epochs 10] " \
+              "[--batch_size 32] [--headless] [--profile_dir logs/profile] [--intra_op_threads 0] " \
+              "[--inter_op_threads 0] [--mixed_precision] [--strategy default|mirrored|multi_worker] " \
+              "[--num_workers 2 --worker_index 0] [--class_map equivalence_classes.json] " \
+              "[--augment]"
+
+STRATEGIES = [
+    'default',
+    'mirrored',
+    'multi_worker'
+]
+
+
+class ThroughputCallback(tf.keras.callbacks.Callback):
+    """
+    Logs the training throughput of every epoch along with the time spent
+    waiting on the input pipeline for the next batch.
+
+    The batches are fetched inside Keras's train function, so the wait is measured from the
+    dataset side instead: timed() records when each batch becomes ready and every step that
+    starts before its batch is ready is counted as waiting for the difference. The first step
+    of fit is left out, the train function being compiled before it asks for a batch.
+    """
+
+    def __init__(self, num_examples):
+        """
+        :param num_examples: The number of training examples seen per epoch.
+        """
+        super().__init__()
+        self.num_examples = num_examples
+        self.epochs = []
+        self.epoch_start = None
+        self.batch_begin = None
+        self.batch_end = None
+        self.stall_time = 0.
+        self.steps = 0
+        self.compiled = False
+        self.ready_times = collections.deque()
+
+    def _ready(self):
+        self.ready_times.append(time.perf_counter())
+        return 0.
+
+    def timed(self, dataset):
+        """
+        Records when each batch of a dataset is ready to be trained on. The batches are
+        passed through unchanged.
+
+        :param dataset: The batched training dataset, as passed to fit.
+        :return: The dataset to pass to fit in its place.
+        """
+        def stamp(*batch):
+            ready = tf.py_function(self._ready, [], tf.float64)
+            with tf.control_dependencies([ready]):
+                return tf.nest.map_structure(tf.identity, batch)
+
+        return dataset.map(stamp).prefetch(1)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.perf_counter()
+        self.batch_end = self.epoch_start
+        self.stall_time = 0.
+        self.steps = 0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.batch_begin = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.batch_end = time.perf_counter()
+        # every epoch consumes its batches in order, so the ready times line up with the steps.
+        # Several steps run between these hooks under steps_per_execution, the first of them
+        # is the one fetched at the start.
+        ready = []
+        while self.steps <= batch and len(self.ready_times) > 0:
+            ready.append(self.ready_times.popleft())
+            self.steps += 1
+        if len(ready) > 0 and self.compiled:
+            self.stall_time += min(max(ready[0] - self.batch_begin, 0.), self.batch_end - self.batch_begin)
+        self.compiled = True
+
+    def on_epoch_end(self, epoch, logs=None):
+        epoch_time = self.batch_end - self.epoch_start
+        stats = {
+            'epoch': epoch,
+            'epoch_time': epoch_time,
+            'examples_per_sec': self.num_examples / epoch_time,
+            'input_stall_time': self.stall_time,
+            'input_stall_fraction': self.stall_time / epoch_time
+        }
+        self.epochs.append(stats)
+        print(f"\nepoch {epoch}: {stats['examples_per_sec']:.1f} examples/sec, "
+              f"{stats['input_stall_time']:.2f}s ({100 * stats['input_stall_fraction']:.1f} %) waiting on input")
+
+
+def local_tf_config(num_workers, worker_index, base_port=12345):
+    """
+    Builds a TF_CONFIG for a multi-worker cluster of processes on localhost.
+
+    :param num_workers: The number of worker processes.
+    :param worker_index: The index of this process.
+    :param base_port: The port of the first worker, the others follow it.
+    :return: The TF_CONFIG as a JSON string.
+    """
+    return json.dumps({
+        'cluster': {'worker': [f'localhost:{base_port + i}' for i in range(num_workers)]},
+        'task': {'type': 'worker', 'index': worker_index}
+    })
+
+
+def configure_runtime(intra_op_threads=0, inter_op_threads=0, mixed_precision=False, strategy='default'):
+    """
+    Configures threading, precision and distribution before any TensorFlow op runs.
+
+    :param intra_op_threads: Threads used within an op, 0 lets TensorFlow pick.
+    :param inter_op_threads: Threads used to run independent ops, 0 lets TensorFlow pick.
+    :param mixed_precision: Whether to compute in bfloat16 while keeping float32 variables.
+    :param strategy: One of STRATEGIES, multi_worker reads the cluster from TF_CONFIG.
+    :raises: ValueError
+    :return: The distribution strategy.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f'Unsupported strategy {strategy}, expected one of {STRATEGIES}.')
+
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+    if mixed_precision:
+        tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
+
+    if strategy == 'multi_worker':
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    if strategy == 'mirrored':
+        return tf.distribute.MirroredStrategy()
+    return tf.distribute.get_strategy()
+
+
+def is_chief():
+    """
+    Whether this process should write the model, plots and reports.
+
+    :return: True unless TF_CONFIG names this process as a non-chief worker.
+    """
+    task = json.loads(os.environ.get('TF_CONFIG', '{}')).get('task', {})
+    return task.get('type', 'chief') == 'chief' or (task.get('type') == 'worker' and task.get('index', 0) == 0)
+
+
+def load_datasets(data_dir='examples/gen', batch_size=32, validation_split=0.2, seed=123, class_map=None,
+                  augment=False, backgrounds=None):
+    """
+    Builds the training and validation pipelines over the circuit images.
+
+    The encoded jpegs are cached in memory so that decoding and resizing, which
+    run in parallel, are the only per-epoch input work.
+
+    :param data_dir: The folder holding one sub-folder of images per circuit.
+    :param batch_size: The batch size.
+    :param validation_split: The fraction of images held out for validation.
+    :param seed: The seed of the train/validation shuffle.
+    :param class_map: A dict of folder to the class it is merged into, e.g. circuits to the first
+        circuit with the same unitary from unitary.py.
+    :param augment: Whether to randomly scale, shift, blur and jpeg compress the training images.
+    :param backgrounds: A pool of background text crops to composite training images onto.
+    :return: The training and validation datasets, the class names and the number of training images.
+    """
+    data_dir = pathlib.Path(data_dir)
+    folders = sorted(path.name for path in data_dir.iterdir() if path.is_dir())
+    class_map = class_map or {}
+    class_names = sorted(set(class_map.get(folder, folder) for folder in folders))
+    labels_by_name = {class_name: label for label, class_name in enumerate(class_names)}
+
+    paths = []
+    labels = []
+    for folder in folders:
+        for image in sorted((data_dir / folder).glob('*.jpg')):
+            paths.append(str(image))
+            labels.append(labels_by_name[class_map.get(folder, folder)])
+
+    order = list(range(len(paths)))
+    random.Random(seed).shuffle(order)
+    paths = [paths[i] for i in order]
+    labels = [labels[i] for i in order]
+    split = int(len(paths) * (1 - validation_split))
+
+    def decode(image, label):
+        return decode_image(image), label
+
+    options = tf.data.Options()
+    # the file list is in memory so workers split it by element
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+
+    def dataset(start, stop, training):
+        ds = tf.data.Dataset.from_tensor_slices((paths[start:stop], labels[start:stop])) \
+            .map(lambda path, label: (tf.io.read_file(path), label), num_parallel_calls=tf.data.AUTOTUNE) \
+            .cache()
+        if training:
+            ds = ds.shuffle(stop - start, seed=seed, reshuffle_each_iteration=True)
+        ds = ds.map(decode, num_parallel_calls=tf.data.AUTOTUNE)
+        if training and augment:
+            # new variants every epoch from the cached jpegs, in place of re-rendering through pdflatex
+            ds = ds.map(lambda image, label: (jpeg_artifacts(image), label), num_parallel_calls=tf.data.AUTOTUNE)
+        ds = ds.batch(batch_size)
+        if training and augment:
+            pool = None if backgrounds is None else tf.constant(backgrounds)
+            ds = ds.map(lambda images, labels: (augment_batch(images, pool), labels),
+                        num_parallel_calls=tf.data.AUTOTUNE)
+        return ds.prefetch(tf.data.AUTOTUNE) \
+            .with_options(options)
+
+    train_ds = dataset(0, split, True)
+    val_ds = dataset(split, len(paths), False)
+    print(f"{len(paths)} images, {split} for training and {len(paths) - split} for validation")
+
+    return train_ds, val_ds, class_names, split
+
+
+def build_model(num_classes):
+    """
+    Builds the circuit classifier.
+
+    :param num_classes: The number of circuits to classify.
+    :return: The compiled model.
+    """
+    # TODO: solve for model that is well suited to learning quantum circuits
+
+    # explicit names keep the exported signature stable when the model is built again in the same session
+    model = Sequential([
+        layers.Input(shape=IMAGE_SIZE + (3,), name='image'),
+        layers.Rescaling(1./255),
+        layers.Conv2D(16, 3, padding='same', activation='relu'),
+        layers.MaxPooling2D(),
+        layers.Conv2D(32, 3, padding='same', activation='relu'),
+        layers.MaxPooling2D(),
+        layers.Conv2D(64, 3, padding='same', activation='relu'),
+        layers.MaxPooling2D(),
+        layers.Flatten(),
+        layers.Dense(128, activation='relu'),
+        # keep the logits in float32 under mixed precision
+        layers.Dense(num_classes, dtype='float32', name='logits')
+    ])
+
+    model.compile(
+        optimizer='adam',
+        loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+        metrics=['accuracy']
+    )
+    return model
+
+
+def plot_samples(train_ds):
+    """
+    Shows a grid of sample training images.
+
+    :param train_ds: The training dataset.
+    """
+    plt.figure(figsize=(10, 10))
+    for images, labels in train_ds.take(1):
+        for i in range(min(9, len(images))):
+            ax = plt.subplot(3, 3, i + 1)
+            plt.imshow(images[i].numpy().astype("uint8"))
+            plt.axis("off")
+    plt.show()
+
+
+def plot_history(history, path=None):
+    """
+    Plots the training and validation accuracy and loss.
+
+    :param history: The training history.
+    :param path: Where to save the plot instead of showing it.
+    """
+    #Accuracy
+    acc = history.history['accuracy']
+    val_acc = history.history['val_accuracy']
+
+    #loss
+    loss = history.history['loss']
+    val_loss = history.history['val_loss']
+
+    #epochs
+    epochs_range = range(len(acc))
+
+    #Plotting graphs
+    plt.figure(figsize=(8, 8))
+    plt.subplot(1, 2, 1)
+    plt.plot(epochs_range, acc, label='Training Accuracy')
+    plt.plot(epochs_range, val_acc, label='Validation Accuracy')
+    plt.legend(loc='lower right')
+    plt.title('Training and Validation Accuracy')
+
+    plt.subplot(1, 2, 2)
+    plt.plot(epochs_range, loss, label='Training Loss')
+    plt.plot(epochs_range, val_loss, label='Validation Loss')
+    plt.legend(loc='upper right')
+    plt.title('Training and Validation Loss')
+
+    if path is None:
+        plt.show()
+    else:
+        plt.savefig(path)
+
+
+def train(data_dir='examples/gen', epochs=10, batch_size=32, headless=False, profile_dir=None, strategy=None,
+          class_map=None, augment=False):
+    """
+    Trains the circuit classifier, saves it and exports it to TFLite.
+
+    :param data_dir: The folder holding one sub-folder of images per circuit.
+    :param epochs: The number of epochs to train for.
+    :param batch_size: The batch size per replica.
+    :param headless: Whether to save plots to files instead of showing them.
+    :param profile_dir: Where to write TensorBoard profiler traces, if anywhere.
+    :param strategy: The distribution strategy from configure_runtime, defaults to the current one.
+    :param class_map: A dict of folder to the class it is merged into.
+    :param augment: Whether to augment the training images on the fly, compositing them onto
+        background text when the cached pool is available or can be rendered.
+    :return: The model, its training history and the per-epoch throughput.
+    """
+    strategy = strategy or tf.distribute.get_strategy()
+    chief = is_chief()
+
+    if headless or not chief:
+        matplotlib.use('Agg')
+
+    train_ds, val_ds, class_names, num_train = load_datasets(
+        data_dir, batch_size * strategy.num_replicas_in_sync, class_map=class_map,
+        augment=augment, backgrounds=background_pool() if augment else None
+    )
+    print(class_names)
+
+    if not headless and chief:
+        plot_samples(train_ds)
+
+    with strategy.scope():
+        model = build_model(len(class_names))
+    model.summary()
+
+    throughput = ThroughputCallback(num_train)
+    callbacks = [throughput]
+    if profile_dir is not None:
+        callbacks.append(tf.keras.callbacks.TensorBoard(log_dir=profile_dir, profile_batch=(10, 20)))
+
+    history = model.fit(
+        throughput.timed(train_ds),
+        validation_data=val_ds,
+        epochs=epochs,
+        callbacks=callbacks
+    )
+
+    if not chief:
+        return model, history, throughput.epochs
+
+    plot_history(history, 'training_history.png' if headless else None)
+
+    if tf.keras.mixed_precision.global_policy().name != 'float32' or strategy is not tf.distribute.get_strategy():
+        # export an undistributed float32 copy, the weights are kept in float32 anyway
+        tf.keras.mixed_precision.set_global_policy('float32')
+        export_model = build_model(len(class_names))
+        export_model.set_weights(model.get_weights())
+    else:
+        export_model = model
+
+    tf.saved_model.save(export_model, f'saved_models/trained_model')
+
+    # tool.py reads the circuit behind each output from this
+    with open('class_names.json', 'w') as f:
+        json.dump(class_names, f)
+
+    # convert the model and compare its quantized variants
+    export_report(export_model, val_ds, data_dir=data_dir)
+
+    return model, history, throughput.epochs
+
+
+def main(argv):
+    data_dir = 'examples/gen'
+    epochs = 10
+    batch_size = 32
+    headless = False
+    profile_dir = None
+    intra_op_threads = 0
+    inter_op_threads = 0
+    mixed_precision = False
+    strategy = 'default'
+    num_workers = None
+    worker_index = 0
+    class_map = None
+    augment = False
+
+    try:
+        opts, args = getopt.getopt(
+            argv,
+            "h",
+            ["help", "data_dir=", "epochs=", "batch_size=", "headless", "profile_dir=", "intra_op_threads=",
+             "inter_op_threads=", "mixed_precision", "strategy=", "num_workers=", "worker_index=", "class_map=", "augment"]
+        )
+    except getopt.GetoptError:
+        print(HELP_STRING)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ["-h", "--help"]:
+            print(HELP_STRING)
+            sys.exit()
+        elif opt == "--data_dir":
+            data_dir = arg
+        elif opt == "--epochs":
+            epochs = int(arg)
+        elif opt == "--batch_size":
+            batch_size = int(arg)
+        elif opt == "--headless":
+            headless = True
+        elif opt == "--profile_dir":
+            profile_dir = arg
+        elif opt == "--intra_op_threads":
+            intra_op_threads = int(arg)
+        elif opt == "--inter_op_threads":
+            inter_op_threads = int(arg)
+        elif opt == "--mixed_precision":
+            mixed_precision = True
+        elif opt == "--strategy":
+            strategy = arg
+        elif opt == "--num_workers":
+            num_workers = int(arg)
+        elif opt == "--worker_index":
+            worker_index = int(arg)
+        elif opt == "--class_map":
+            with open(arg, 'r') as f:
+                class_map = json.load(f)
+        elif opt == "--augment":
+            augment = True
+
+    if num_workers is not None:
+        os.environ['TF_CONFIG'] = local_tf_config(num_workers, worker_index)
+        strategy = 'multi_worker'
+
+    strategy = configure_runtime(intra_op_threads, inter_op_threads, mixed_precision, strategy)
+
+    train(data_dir, epochs, batch_size, headless, profile_dir, strategy, class_map, augment)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,25 @@
+import tensorflow as tf
+
+# the size circuit images are read at by training, calibration and inference alike
+IMAGE_SIZE = (400, 600)
+
+
+def decode_image(contents):
+    """
+    Decodes a jpeg and resizes it to IMAGE_SIZE.
+
+    :param contents: The encoded jpeg.
+    :return: The float image, IMAGE_SIZE + (3,) in shape.
+    """
+    image = tf.image.decode_jpeg(contents, channels=3)
+    return tf.image.resize(image, size=IMAGE_SIZE)
+
+
+def load_image(path):
+    """
+    Reads a jpeg and resizes it to IMAGE_SIZE.
+
+    :param path: The path to the jpeg.
+    :return: The float image, IMAGE_SIZE + (3,) in shape.
+    """
+    return decode_image(tf.io.read_file(path))
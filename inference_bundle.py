@@ -0,0 +1,204 @@
+import tensorflow as tf
+import numpy as np
+import contextlib
+import getopt
+import struct
+import json
+import mmap
+import sys
+import io
+import os
+
+from functools import lru_cache
+
+from circuit_builder import Builder
+
+DEFAULT_BUNDLE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'inference.bundle')
+
+MAGIC = b'QCBUNDLE'
+
+# the bundle ends in the magic, the number of classes and the offsets of the QASM index and the metadata
+TRAILER = struct.Struct('<8sQQQ')
+
+HELP_STRING = "Usage: python inference_bundle.py [--model_file model.tflite] [--data_dir examples/gen] " \
+              "[--max_depth 4] [--qubits 2] [--output inference.bundle]"
+
+
+def class_circuits(model_file='model.tflite', num_classes=6000):
+    """
+    Lists the circuit behind every output of a classification model.
+
+    :param model_file: The model, whose class_names.json is read when training wrote one next to it.
+    :param num_classes: The number of outputs when there is no class_names.json.
+    :return: The circuit id of every output.
+    """
+    class_names_path = os.path.join(os.path.dirname(os.path.abspath(model_file)), 'class_names.json')
+    if os.path.exists(class_names_path):
+        with open(class_names_path, 'r') as f:
+            return [int(name) for name in json.load(f)]
+
+    # while its a 1-1 mapping it isn’t exactly in-order numerically, rather its alphanumerically.
+    sorted_ints = map(lambda j: int(j), sorted([str(i) for i in range(num_classes)]))
+    circuits = [0] * num_classes
+    for k, nt in enumerate(sorted_ints):
+        circuits[nt] = k
+    return circuits
+
+
+def circuit_qasm(circuit, data_dir='examples/gen', max_circuit_depth=4, qubits=2):
+    """
+    Reads the QASM of a generated circuit, building it from its id when the file is missing.
+    """
+    path = os.path.join(data_dir, f'circuit_{circuit}.qasm')
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return f.read()
+    # test_data_generation pulls in the PDF parser, which loading a bundle does not need
+    from test_data_generation import build_qasm, circuit_at
+
+    builder = Builder(pad=False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        build_qasm(circuit_at(circuit, max_circuit_depth, qubits), builder)
+    return builder.program
+
+
+def write_bundle(model_file='model.tflite', data_dir='examples/gen', path=DEFAULT_BUNDLE_PATH,
+                 max_circuit_depth=4, qubits=2):
+    """
+    Packs a TFLite model and the QASM of every class into one file.
+
+    The flatbuffer comes first so the interpreter can map the bundle itself, trailing data being
+    ignored by TFLite. It is followed by the offsets of every class's QASM, the QASM, a JSON
+    metadata block and a fixed size trailer locating them.
+
+    :param model_file: The TFLite classification model.
+    :param data_dir: The folder holding the circuit_N.qasm files.
+    :param path: The bundle to write.
+    :param max_circuit_depth: The max depth of the enumeration, to build QASM missing from data_dir.
+    :param qubits: The number of qubits of the enumeration.
+    :return: The size of the bundle in bytes.
+    """
+    with open(model_file, 'rb') as f:
+        model = f.read()
+
+    interpreter = tf.lite.Interpreter(model_content=model)
+    num_classes = int(interpreter.get_output_details()[0]['shape'][-1])
+    circuits = class_circuits(model_file)[:num_classes]
+
+    programs = []
+    for circuit in circuits:
+        try:
+            programs.append(circuit_qasm(circuit, data_dir, max_circuit_depth, qubits).encode('utf-8'))
+        except IndexError:
+            # the legacy mapping names circuits past the end of the enumeration
+            programs.append(b'')
+    offsets = np.zeros(len(programs) + 1, dtype='<u8')
+    offsets[1:] = np.cumsum([len(program) for program in programs])
+
+    # the index is read in place as uint64s, so it starts on an 8 byte boundary
+    index_offset = (len(model) + 7) // 8 * 8
+    metadata = json.dumps({
+        'model_file': os.path.basename(model_file),
+        'model_size': len(model),
+        'circuits': circuits
+    }).encode('utf-8')
+    metadata_offset = index_offset + offsets.nbytes + int(offsets[-1])
+
+    with open(path, 'wb') as f:
+        f.write(model)
+        f.write(b'\0' * (index_offset - len(model)))
+        f.write(offsets.tobytes())
+        for program in programs:
+            f.write(program)
+        f.write(metadata)
+        f.write(TRAILER.pack(MAGIC, len(programs), index_offset, metadata_offset))
+    return os.path.getsize(path)
+
+
+class InferenceBundle(object):
+    """
+    A bundle mapped read only into memory. Nothing is copied on load: the interpreter maps the
+    flatbuffer at the start of the file and the QASM index is a view into the mapping, so every
+    process using the bundle shares the same pages of the OS page cache. A bundle opened before
+    forking is inherited by the workers as is.
+    """
+
+    def __init__(self, path=DEFAULT_BUNDLE_PATH):
+        """
+        :param path: The bundle written by write_bundle.
+        :raises: ValueError
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        trailer = len(self._map) - TRAILER.size
+        magic, num_classes, index_offset, metadata_offset = TRAILER.unpack_from(self._map, trailer)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not an inference bundle.')
+        self._offsets = np.frombuffer(self._map, dtype='<u8', count=num_classes + 1, offset=index_offset)
+        self._data_offset = index_offset + self._offsets.nbytes
+        self.metadata = json.loads(self._map[metadata_offset:trailer])
+
+        self.interpreter = tf.lite.Interpreter(model_path=path)
+        self.classify = self.interpreter.get_signature_runner('serving_default')
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def qasm(self, label):
+        """
+        Looks up the QASM of a class.
+
+        :param label: The output of the model.
+        :return: The QASM.
+        """
+        start = self._data_offset + int(self._offsets[label])
+        stop = self._data_offset + int(self._offsets[label + 1])
+        return self._map[start:stop].decode('utf-8')
+
+
+@lru_cache(maxsize=None)
+def load_bundle(path=DEFAULT_BUNDLE_PATH):
+    """
+    Opens a bundle once per process.
+    """
+    return InferenceBundle(path)
+
+
+def main(argv):
+    model_file = 'model.tflite'
+    data_dir = 'examples/gen'
+    max_depth = 4
+    qubits = 2
+    output = DEFAULT_BUNDLE_PATH
+
+    try:
+        opts, args = getopt.getopt(
+            argv, "h", ["help", "model_file=", "data_dir=", "max_depth=", "qubits=", "output="]
+        )
+    except getopt.GetoptError:
+        print(HELP_STRING)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ["-h", "--help"]:
+            print(HELP_STRING)
+            sys.exit()
+        elif opt == "--model_file":
+            model_file = arg
+        elif opt == "--data_dir":
+            data_dir = arg
+        elif opt == "--max_depth":
+            max_depth = int(arg)
+        elif opt == "--qubits":
+            qubits = int(arg)
+        elif opt == "--output":
+            output = arg
+
+    size = write_bundle(model_file, data_dir, output, max_depth, qubits)
+    print(f"Wrote {output} ({size / 2 ** 20:.2f} MB)")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,47 @@
+import re
+
+
+def qasm_instructions(qasm):
+    """
+    Reads the instructions of a QASM program, leaving out the header, registers and gate definitions.
+
+    :param qasm: The QASM.
+    :return: A list of (name, qubits) with qubits a tuple of indices.
+    """
+    qasm = re.sub(r'gate\s+\w+[^{]*{[^}]*}', '', qasm)
+    instructions = []
+    for statement in qasm.split(';'):
+        statement = statement.strip()
+        match = re.match(r'([a-zA-Z_]\w*)(\([^)]*\))?\s+(.*)', statement, re.DOTALL)
+        if match is None or match.group(1) in ['OPENQASM', 'include', 'qreg', 'creg']:
+            continue
+        name = match.group(1) + (match.group(2) or '')
+        qubits = tuple(int(qubit) for qubit in re.findall(r'\w+\[(\d+)\]', match.group(3).split('->')[0]))
+        instructions.append((name, qubits))
+    return instructions
+
+
+def wire_sequences(instructions):
+    """
+    Projects instructions onto each qubit. Two programs with the same projections apply the same
+    gates in the same order on every qubit, and only differ in how independent gates interleave.
+
+    :param instructions: A list of (name, qubits).
+    :return: A dict of qubit to the list of instructions acting on it.
+    """
+    sequences = {}
+    for name, qubits in instructions:
+        for qubit in qubits:
+            sequences.setdefault(qubit, []).append((name, qubits))
+    return sequences
+
+
+def same_circuit(qasm, reference):
+    """
+    Compares two QASM programs by instruction IR rather than by text.
+
+    :param qasm: The QASM to check.
+    :param reference: The expected QASM.
+    :return: Whether every qubit sees the same instructions in the same order.
+    """
+    return wire_sequences(qasm_instructions(qasm)) == wire_sequences(qasm_instructions(reference))
@@ -1,11 +1,20 @@
 import pdfquery
 import numpy as np
+import time
 from lxml import etree
+from multiprocessing import Pool
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+from pdfminer.converter import PDFPageAggregator
+from pdfminer.layout import LTCurve, LTChar, LTContainer
 from operator import itemgetter
 from copy import deepcopy
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from circuit_builder import Builder
-from typing import Optional
+from result_cache import content_key, shared_cache
+from typing import Optional, Callable, Tuple
 
 
 GATES = [
@@ -31,10 +40,24 @@ GATES = [
     # 'ccz'
 ]
 
+# bump whenever a change to the parser changes the QASM it produces, so cached results are not reused
+PARSER_VERSION = '2'
+
 TOKENS = {
-    'control': '•'
+    'control': '•',
+    'dagger': '†'
+}
+
+# gate labels whose rendered text is not their QASM name
+TEXT_GATES = {
+    's†': 'sdg'
 }
 
+# the geometry of the drawing, in pdf points
+CLUSTER_GAP = 5.
+WIRE_MARGIN = 10.
+ALIGN_MARGIN = 3.
+
 
 @dataclass
 class Gate(object):
@@ -62,147 +85,291 @@ class Gate(object):
         return self.__hash__() == other.__hash__()
 
 
-def parse_circuit(path_to_pdf="examples/pdf/Circuits.pdf", path_to_xml="examples/pdf/readable.xml"):
+@dataclass
+class ParseStats(object):
     """
-    Parses a pdf and returns QASM.
+    Timings and counters collected while parsing a circuit.
+    """
+    files: int = 0
+    load_time: float = 0.
+    dump_time: float = 0.
+    walk_time: float = 0.
+    delegation_time: float = 0.
+    total_time: float = 0.
+    element_counts: dict = field(default_factory=dict)
+    wires: int = 0
+    controls: int = 0
+    cnots: int = 0
+    delegation_iterations: int = 0
+    process_gates_calls: int = 0
+    cache_hits: int = 0
+
+    def merge(self, other):
+        """
+        Adds the timings and counters of another parse to these, to aggregate over a batch.
+
+        :param other: The ParseStats to add.
+        :return: self
+        """
+        for name in ['files', 'load_time', 'dump_time', 'walk_time', 'delegation_time', 'total_time', 'wires',
+                     'controls', 'cnots', 'delegation_iterations', 'process_gates_calls', 'cache_hits']:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for tag, count in other.element_counts.items():
+            self.element_counts[tag] = self.element_counts.get(tag, 0) + count
+        return self
 
-    Limitations:
-        - only one control per x index in the circuit.
-        - limited to the gates in the GATES array above.
 
-    :param path_to_pdf: The path to the pdf of the circuit.
-    :param path_to_xml: Path to the intermediate .xml document to create for parsing.
+@dataclass
+class ParsedCircuit(object):
+    """
+    The QASM of a circuit found in a region of a page.
+    """
+    page: int
+    bbox: Tuple[float, float, float, float]
+    qasm: str
 
-    :return: The QASM.
+
+@dataclass
+class LayoutRecord(object):
+    """
+    A text line or drawing primitive extracted without pdfminer's layout analysis,
+    shaped like the elements of the pdfquery tree.
     """
-    pdf = pdfquery.PDFQuery(path_to_pdf)
-    pdf.load()
+    tag: str
+    text: Optional[str]
+    attrib: dict
 
-    pdf.tree.write(path_to_xml, pretty_print=True)
 
-    tree = etree.parse(open(path_to_xml, "r"))
-    root = tree.getroot()
+def _boxes(records):
+    """
+    Stacks the (x0, y0, x1, y1) of layout records into an (n, 4) array.
+    """
+    return np.array([[float(record.attrib[key]) for key in ['x0', 'y0', 'x1', 'y1']] for record in records],
+                    dtype=float).reshape(-1, 4)
+
+
+def _tokens(text, box, vertical=False):
+    """
+    Splits the text of a box into tokens with the positions they take up, for text boxes
+    that pdfminer merged across several gates of a wire (or of a column, when vertical).
+
+    :param text: The text of the box.
+    :param box: The (x0, y0, x1, y1) of the box.
+    :param vertical: Whether the text runs from the top of the box to the bottom.
+    :return: A list of (token, x0, x1, y) with y the vertical centre of the token.
+    """
+    text = text.strip()
+    tokens = []
+    offset = 0
+    for token in text.split():
+        offset = text.index(token, offset)
+        start = offset / len(text)
+        stop = (offset + len(token)) / len(text)
+        if vertical:
+            y = box[3] - (box[3] - box[1]) * (start + stop) / 2
+            tokens.append((token.lower(), float(box[0]), float(box[2]), float(y)))
+        else:
+            width = box[2] - box[0]
+            tokens.append((token.lower(), float(box[0] + start * width), float(box[0] + stop * width),
+                           float((box[1] + box[3]) / 2)))
+        offset += len(token)
+    return tokens
 
-    wires = {}
-    controls = {}
-    curve_y_extents = []
-    curve_x_extents = []
 
-    for element in root.iter(tag=etree.Element):
+def cluster_1d(values, gap=CLUSTER_GAP):
+    """
+    Clusters values on a line, starting a new cluster wherever consecutive sorted values
+    are further than gap apart.
+
+    :param values: The 1-D array of values.
+    :param gap: The largest distance between neighbours of a cluster.
+    :return: The median of every cluster, in ascending order.
+    """
+    if len(values) == 0:
+        return np.empty(0)
+    values = np.sort(values)
+    splits = np.flatnonzero(np.diff(values) > gap) + 1
+    return np.array([np.median(cluster) for cluster in np.split(values, splits)])
+
+
+def group_overlapping(boxes, margin=.5):
+    """
+    Labels the connected components of boxes that overlap or touch, such as the arcs of a circle.
+
+    :param boxes: The (n, 4) array of boxes.
+    :param margin: How far apart boxes may be and still touch.
+    :return: An array holding the component label of every box.
+    """
+    # a sweep with union-find rather than an n x n adjacency matrix, which large pages cannot afford
+    return connected_boxes(boxes, margin)
+
+
+def find_wires(lines):
+    """
+    Finds the vertical positions of the wires from the horizontal line segments drawn for them,
+    leaving out the top and bottom edges of gate boxes, which meet a vertical line at a corner.
+
+    :param lines: The (n, 4) array of line and rectangle boxes.
+    :return: The vertical positions of the wires in ascending order.
+    """
+    horizontal = lines[(lines[:, 3] - lines[:, 1] < 1.) & (lines[:, 2] - lines[:, 0] > 1.)]
+    vertical = lines[(lines[:, 2] - lines[:, 0] < 1.) & (lines[:, 3] - lines[:, 1] > 1.)]
+    if len(vertical):
+        y = horizontal[:, 1][:, None]
+        at_corner = (np.abs(horizontal[:, 0][:, None] - vertical[None, :, 0]) < 1.) \
+            & ((np.abs(y - vertical[None, :, 1]) < 1.) | (np.abs(y - vertical[None, :, 3]) < 1.))
+        horizontal = horizontal[~at_corner.any(axis=1)]
+    return cluster_1d(horizontal[:, 1])
+
+
+def walk_elements(elements, element_counts=None):
+    """
+    Collects the wires, gates and controls of a circuit from its layout elements.
+
+    The coordinates of the elements are gathered into arrays in one pass. Wires are clustered
+    from the vertical positions of their line segments, CNOT targets are groups of overlapping
+    curves (the arcs of the circle) and each target is matched to the control in line with it.
+
+    :param elements: The layout elements in document order, each with a tag, text and attrib.
+    :param element_counts: A dict to count the elements by tag into.
+
+    :return: The wires (gates by vertical position), the controls and the number of CNOTs found.
+    """
+    texts = []
+    curves = []
+    lines = []
+
+    for element in elements:
+        if element_counts is not None:
+            element_counts[element.tag] = element_counts.get(element.tag, 0) + 1
+
         if 'x0' in element.attrib.keys():
             print("%s - %s - (%s, %s)" % (element.tag, element.text, element.attrib['x0'], element.attrib['y0']))
 
-        # if we have a wire
-        if element.tag == 'LTTextLineHorizontal':
-            # get the vertical position
-            y = element.attrib['y0']
-            # register the wire
-            if y not in wires.keys():
-                if len(wires.keys()) == 0:
-                    wires[y] = []
-                    continue
-                skip = False
-                for w in wires.keys():
-                    if np.abs(float(y) - float(w)) < 10:  # merge with wire by proximity
-                        skip = True
-                if skip:
-                    continue
-                for w in wires.keys():
-                    if np.abs(float(y) - float(w)) < 100:  # check if its part of the circuit
-                        wires[y] = []
-                        break
+        if element.tag.startswith('LTText') and element.text and element.text.strip():
+            texts.append(element)
+        elif element.tag == 'LTCurve':
+            curves.append(element)
+        elif element.tag in ['LTLine', 'LTRect']:
+            lines.append(element)
+
+    wire_ys = find_wires(_boxes(lines))
+    if len(wire_ys) == 0:
+        return {}, {}, 0
+
+    # top to bottom, so the first wire is q[0]
+    wire_ys = wire_ys[::-1]
+    wires = {float(y): [] for y in wire_ys}
+    keys = list(wires.keys())
+
+    def nearest_wire(y):
+        distances = np.abs(wire_ys[None, :] - np.atleast_1d(y)[:, None])
+        nearest = distances.argmin(axis=1)
+        return nearest, distances[np.arange(len(nearest)), nearest] < WIRE_MARGIN
+
+    # every token of every text box, deduplicated as pdfquery may repeat text on a line and its box
+    tokens = []
+    seen = set()
+    for element, box in zip(texts, _boxes(texts)):
+        for token, x0, x1, y in _tokens(element.text, box, element.tag.endswith('Vertical')):
+            if (token, x0, y) not in seen:
+                seen.add((token, x0, y))
+                tokens.append((TEXT_GATES.get(token, token), x0, x1, y))
 
-        # if we have a curve
-        if element.tag == 'LTCurve':  # TODO: can we rely on these coming after the controls dict is populated?
-
-            # collect curve extents
-            curve_y_extents.append(float(element.attrib['y0']))
-            curve_y_extents.append(float(element.attrib['y1']))
-            curve_x_extents.append(float(element.attrib['x0']))
-            curve_x_extents.append(float(element.attrib['x1']))
-
-            # if we have all the curve extents of a CNOT gate
-            if len(curve_y_extents) == 8:
-                for wire in wires.keys():
-                    # find the target wire
-                    if float(wire) <= max(curve_y_extents):  # TODO: There must be a better criteria
-                        for w in controls.keys():
-                            ctrls = controls[w]
-                            for ctrl in ctrls:
-                                # find the controls
-                                if min(curve_x_extents) <= float(ctrl) <= max(curve_x_extents):
-                                    # reverse lookup controls
-                                    for source_y in controls.keys():
-                                        if ctrl in controls[source_y]:
-                                            # sort the CNOT position with respect to both wires' gates
-                                            gate_params = {'name': 'cx', 'source': source_y, 'index': ctrl}
-                                            wires[source_y].append(Gate(**gate_params))
-                                            wires[source_y] = sorted(wires[source_y], key=itemgetter('index'))
-
-                                            for source_index, gate in enumerate(wires[source_y]):
-                                                if gate['name'] == 'cx' \
-                                                        and gate['source'] == source_y \
-                                                        and gate['index'] == ctrl:
-                                                    break
-
-                                            gate_params = {
-                                                'name': 'cx',
-                                                'source': source_y,
-                                                'source_index': source_index,
-                                                'index': ctrl
-                                            }
-                                            wires[wire].append(Gate(**gate_params))
-                                            wires[wire] = sorted(wires[wire], key=itemgetter('index'))
-                                            break
-                        break
-        else:
-            curve_y_extents = []
-            curve_x_extents = []
-
-        # if we have a gate
-        if element.tag == 'LTTextBoxHorizontal':
-            # find the wire
-            wire = element.attrib['y0']
-            # get the text
-            text = element.text.strip().lower()
-            # register the wire if needed
-            if wire not in wires.keys():
-                if len(wires.keys()) == 0:
-                    wires[wire] = []
-                    continue
-                for w in wires.keys():
-                    if np.abs(float(wire) - float(w)) < 10:  # merge with wire by proximity
-                        wire = w
-                        break
-                for w in wires.keys():
-                    if np.abs(float(wire) - float(w)) < 100:  # check if its part of the circuit
-                        wires[wire] = []
-                        break
-            # register the gate
-            if text in GATES:
-                wires[wire].append({'name': text, 'index': element.attrib['x0'], 'wire': wire})
-                # sort the wire's gates by x index
-                wires[wire] = sorted(wires[wire], key=itemgetter('index'))
-            # if this is a part of a controlled gate register the control
-            elif text in list(TOKENS.values()):
-                if text == TOKENS['control']:
-                    if wire in controls.keys():
-                        controls[wire].append(element.attrib['x0'])
-                        controls[wire] = sorted(controls[wire])
-                    else:
-                        controls[wire] = [element.attrib['x0']]
-            # register custom gates
-            elif wire in wires.keys():  # filters out page numbering etc.
-                wires[wire].append({'name': 'custom:' + text, 'index': element.attrib['x0'], 'wire': wire})
-                # sort the wire's gates by x index
-                wires[wire] = sorted(wires[wire], key=itemgetter('index'))
+    controls = {}
+    control_x = []
+    control_wire = []
+    daggers = []
+    if len(tokens):
+        token_wire, on_wire = nearest_wire(np.array([token[3] for token in tokens]))
+        for (token, x0, x1, y), w, kept in zip(tokens, token_wire, on_wire):
+            if not kept:  # page numbering, captions etc.
+                continue
+            if token == TOKENS['dagger']:
+                daggers.append((x0, keys[w]))
+            elif token == TOKENS['control']:
+                controls.setdefault(keys[w], []).append(x0)
+                control_x.append((x0 + x1) / 2)
+                control_wire.append(w)
+            elif token in GATES:
+                wires[keys[w]].append({'name': token, 'index': x0, 'wire': keys[w]})
+            else:
+                wires[keys[w]].append({'name': 'custom:' + token, 'index': x0, 'wire': keys[w]})
+
+    # layout analysis may split a superscript dagger from its gate, so it goes to the gate before it
+    for x0, wire in daggers:
+        before = [gate for gate in wires[wire] if gate['index'] < x0]
+        if len(before):
+            gate = max(before, key=itemgetter('index'))
+            name = gate['name'] + TOKENS['dagger']
+            gate['name'] = TEXT_GATES.get(name, name)
+
+    cnots = 0
+    curve_boxes = _boxes(curves)
+    if len(curve_boxes) and len(control_x):
+        labels = group_overlapping(curve_boxes)
+        groups = np.unique(labels)
+        targets = np.array([np.concatenate([curve_boxes[labels == label, :2].min(axis=0),
+                                            curve_boxes[labels == label, 2:].max(axis=0)]) for label in groups])
+        target_x = (targets[:, 0] + targets[:, 2]) / 2
+        target_wire, on_wire = nearest_wire((targets[:, 1] + targets[:, 3]) / 2)
+
+        control_x = np.array(control_x)
+        control_wire = np.array(control_wire)
+        # controls in line with each target, on another wire
+        aligned = (np.abs(control_x[:, None] - target_x[None, :]) < ALIGN_MARGIN) \
+            & (control_wire[:, None] != target_wire[None, :]) & on_wire[None, :]
+        used = np.zeros(len(control_x), dtype=bool)
+        for t in np.flatnonzero(aligned.any(axis=0)):
+            candidates = np.flatnonzero(aligned[:, t] & ~used)
+            if len(candidates) == 0:
+                continue
+            # the nearest control when several CNOTs share a column
+            c = candidates[np.abs(control_wire[candidates] - target_wire[t]).argmin()]
+            used[c] = True
+            source_y = keys[control_wire[c]]
+            target_y = keys[target_wire[t]]
+            ctrl = controls[source_y][int(np.sum(control_wire[:c] == control_wire[c]))]
+            wires[source_y].append(Gate(name='cx', source=source_y, index=ctrl))
+            wires[target_y].append((source_y, ctrl))
+            cnots += 1
+
+    for wire in keys:
+        wires[wire] = sorted(wires[wire], key=lambda gate: gate[1] if isinstance(gate, tuple) else gate['index'])
+        controls[wire] = sorted(controls[wire]) if wire in controls else []
+    for wire in keys:
+        # the target side records where the CNOT sits among the source wire's gates
+        for i, gate in enumerate(wires[wire]):
+            if isinstance(gate, tuple):
+                source_y, ctrl = gate
+                source_index = next(j for j, other in enumerate(wires[source_y])
+                                    if not isinstance(other, tuple) and other['name'] == 'cx'
+                                    and other['index'] == ctrl)
+                wires[wire][i] = Gate(name='cx', source=source_y, source_index=source_index, index=ctrl)
+    controls = {wire: ctrls for wire, ctrls in controls.items() if len(ctrls)}
+
+    return wires, controls, cnots
+
+
+def emit_qasm(wires):
+    """
+    Writes the gates on the wires to QASM, delegating the gates that follow a CNOT on
+    either of its wires until the gates before it on both wires have been written.
 
+    :param wires: The gates by vertical position of their wire.
+
+    :return: The Builder, the number of delegation loop iterations and of process_gates calls.
+    """
     builder = Builder()
 
     delegated = {}
     w = 0
+    iterations = 0
+    calls = 0
 
     def process_gates(gates, wire, delegating=False):
+        nonlocal calls
+        calls += 1
         to_del = []
 
         for i, gate in enumerate(gates):
@@ -249,6 +416,10 @@ def parse_circuit(path_to_pdf="examples/pdf/Circuits.pdf", path_to_xml="examples
                                     to_del += to_del_subs
                                     delegated[gate] = del_gates
 
+                    if found and delegating:
+                        # the rest of this list was just written as the target wire's delegated gates
+                        gates = []
+                        break
                     if not found and not delegating:
                         # otherwise we delegate this
                         gate.wire = wire
@@ -266,10 +437,11 @@ def parse_circuit(path_to_pdf="examples/pdf/Circuits.pdf", path_to_xml="examples
 
     # while we have gates to process
     while len(delegated.keys()) > 0 or w < len(wires.keys()):
+        iterations += 1
+        to_del = []
         if not w >= len(list(wires.keys())):
             wire = list(wires.keys())[w]
             gates = wires[wire]
-            to_del = []
 
             # process the wires in ascending order
             to_del_plus, gates = process_gates(gates, wire)
@@ -277,21 +449,377 @@ def parse_circuit(path_to_pdf="examples/pdf/Circuits.pdf", path_to_xml="examples
             wires[wire] = gates
 
             for delegate in to_del:
-                del delegated[delegate]
+                delegated.pop(delegate, None)
 
             to_del = []
 
         # try to process delegated gates after each wire is processed
-        for k, delegated_gates in delegated.items():
-            to_del_plus, delegated_gates_sub = process_gates(delegated_gates, k.wire, delegating=True)
+        for k in list(delegated.keys()):
+            if k in to_del or k not in delegated:
+                continue
+            to_del_plus, delegated_gates_sub = process_gates(delegated[k], k.wire, delegating=True)
             to_del += to_del_plus
             delegated[k] = delegated_gates_sub
 
+        if w >= len(wires.keys()) and len(to_del) == 0:
+            # nothing is left that can be written, e.g. a CNOT missing its other end
+            break
+
         for delegate in to_del:
-            del delegated[delegate]
+            delegated.pop(delegate, None)
 
         w += 1
 
     builder.print()
 
-    return builder.program
\ No newline at end of file
+    return builder, iterations, calls
+
+
+def parse_circuit(path_to_pdf="examples/pdf/Circuits.pdf", path_to_xml="examples/pdf/readable.xml",
+                  stats: Optional[ParseStats] = None, callback: Optional[Callable[[ParseStats], None]] = None,
+                  fast=False, bbox=None, cache=None):
+    """
+    Parses a pdf and returns QASM.
+
+    Limitations:
+        - only CNOTs with a single control.
+        - limited to the gates in the GATES array above.
+
+    :param path_to_pdf: The path to the pdf of the circuit.
+    :param path_to_xml: Path to the intermediate .xml document to create for parsing.
+    :param stats: A ParseStats to add this parse's per-stage timings and counters to.
+    :param callback: Called with the ParseStats of this parse once it completes.
+    :param fast: Whether to skip pdfminer's layout analysis and the .xml document, and work
+        from the characters and primitives of the first page.
+    :param bbox: With fast, only parse within this (x0, y0, x1, y1) region, or 'auto' for the
+        region with the most primitives.
+    :param cache: A ResultCache to look the pdf up in before parsing it, or True for the shared cache.
+
+    :return: The QASM.
+    """
+    start = time.perf_counter()
+
+    if cache is True:
+        cache = shared_cache()
+    if cache is not None:
+        key = content_key(path_to_pdf, PARSER_VERSION, 'fast' if fast else 'pdfquery', bbox)
+        qasm = cache.get(key)
+        if qasm is not None:
+            if stats is not None or callback is not None:
+                parse_stats = ParseStats(files=1, total_time=time.perf_counter() - start, cache_hits=1)
+                if stats is not None:
+                    stats.merge(parse_stats)
+                if callback is not None:
+                    callback(parse_stats)
+            return qasm
+
+    if fast:
+        page_number, layout = next(iter_page_layouts(path_to_pdf, [0]))
+        if bbox == 'auto':
+            bbox = detect_bbox(layout)
+        elements = extract_records(layout, bbox)
+        loaded = time.perf_counter()
+        dumped = loaded
+    else:
+        pdf = pdfquery.PDFQuery(path_to_pdf)
+        pdf.load()
+        loaded = time.perf_counter()
+
+        pdf.tree.write(path_to_xml, pretty_print=True)
+
+        tree = etree.parse(open(path_to_xml, "r"))
+        root = tree.getroot()
+        dumped = time.perf_counter()
+        elements = root.iter(tag=etree.Element)
+
+    element_counts = {}
+    wires, controls, cnots = walk_elements(elements, element_counts)
+    walked = time.perf_counter()
+
+    builder, iterations, calls = emit_qasm(wires)
+
+    if stats is not None or callback is not None:
+        end = time.perf_counter()
+        parse_stats = ParseStats(
+            files=1,
+            load_time=loaded - start,
+            dump_time=dumped - loaded,
+            walk_time=walked - dumped,
+            delegation_time=end - walked,
+            total_time=end - start,
+            element_counts=element_counts,
+            wires=len(wires),
+            controls=sum(len(ctrls) for ctrls in controls.values()),
+            cnots=cnots,
+            delegation_iterations=iterations,
+            process_gates_calls=calls
+        )
+        if stats is not None:
+            stats.merge(parse_stats)
+        if callback is not None:
+            callback(parse_stats)
+
+    if cache is not None:
+        cache.put(key, builder.program)
+
+    return builder.program
+
+
+def _primitives(container):
+    """
+    Yields the line and curve primitives of a layout, including those nested in figures.
+    """
+    for obj in container:
+        if isinstance(obj, LTCurve):  # LTLine and LTRect are curves too
+            yield obj
+        elif isinstance(obj, LTContainer):
+            yield from _primitives(obj)
+
+
+def _region_boxes(layout):
+    """
+    Returns the bounding boxes of the primitives that can be part of a circuit, leaving
+    out page backgrounds and frames that span most of the page.
+    """
+    return [primitive.bbox for primitive in _primitives(layout)
+            if primitive.width < layout.width / 2 or primitive.height < layout.height / 2]
+
+
+def _chars(container):
+    """
+    Yields the characters of a layout, including those nested in figures.
+    """
+    for obj in container:
+        if isinstance(obj, LTChar):
+            yield obj
+        elif isinstance(obj, LTContainer):
+            yield from _chars(obj)
+
+
+def _attrib(bbox):
+    return {key: str(round(value, 3)) for key, value in zip(['x0', 'y0', 'x1', 'y1'], bbox)}
+
+
+def group_text_lines(chars, char_margin=1., word_margin=.1, line_overlap=.5):
+    """
+    Groups characters into lines of text the way pdfminer does, without grouping
+    the lines into boxes or ordering the boxes. The default character margin is
+    tighter than pdfminer's so that neighbouring gate labels are not joined.
+
+    :param chars: The LTChars in content stream order.
+    :param char_margin: The gap, relative to the character width, below which characters join a line.
+    :param word_margin: The gap, relative to the character size, above which a space is inserted.
+    :param line_overlap: The vertical overlap, relative to the character height, needed to join a line.
+
+    :return: The (text, bbox) of each line.
+    """
+    lines = []
+    for char in chars:
+        if len(lines) > 0:
+            text, bbox, last = lines[-1]
+            overlap = min(bbox[3], char.y1) - max(bbox[1], char.y0)
+            gap = char.x0 - last.x1
+            if overlap > line_overlap * min(last.height, char.height) \
+                    and -last.width < gap < char_margin * max(last.width, char.width):
+                if gap > word_margin * max(last.width, last.height, char.width, char.height):
+                    text += ' '
+                lines[-1] = (text + char.get_text(), (
+                    min(bbox[0], char.x0), min(bbox[1], char.y0), max(bbox[2], char.x1), max(bbox[3], char.y1)
+                ), char)
+                continue
+        lines.append((char.get_text(), char.bbox, char))
+    return [(text, bbox) for text, bbox, last in lines]
+
+
+def extract_records(layout, bbox=None, margin=10.):
+    """
+    Builds the text lines and drawing primitives of a page interpreted without layout analysis.
+
+    Text lines are ordered top to bottom then left to right and followed by the
+    primitives in content stream order, as in the pdfquery tree.
+
+    :param layout: The LTPage from a PDFPageAggregator without LAParams.
+    :param bbox: Only keep text within and primitives touching this (x0, y0, x1, y1) region.
+    :param margin: The margin around the region.
+
+    :return: The LayoutRecords.
+    """
+    text_records = []
+    for text, line_bbox in sorted(group_text_lines(_chars(layout)), key=lambda line: (-line[1][3], line[1][0])):
+        if bbox is None or _contains(bbox, line_bbox, margin):
+            text_records.append(LayoutRecord(tag='LTTextLineHorizontal', text=None, attrib=_attrib(line_bbox)))
+            text_records.append(LayoutRecord(tag='LTTextBoxHorizontal', text=text, attrib=_attrib(line_bbox)))
+
+    primitive_records = [
+        LayoutRecord(tag=primitive.__class__.__name__, text=None, attrib=_attrib(primitive.bbox))
+        for primitive in _primitives(layout) if bbox is None or _overlaps(bbox, primitive.bbox, margin)
+    ]
+    return text_records + primitive_records
+
+
+def iter_page_layouts(path_to_pdf, pages=None):
+    """
+    Lazily interprets the pages of a pdf without layout analysis, which is cheap,
+    leaving the characters and drawing primitives of each ungrouped.
+
+    :param path_to_pdf: The path to the pdf.
+    :param pages: The page numbers to interpret, defaults to every page.
+
+    :return: Yields the page number and its LTPage.
+    """
+    with open(path_to_pdf, 'rb') as f:
+        document = PDFDocument(PDFParser(f))
+        manager = PDFResourceManager()
+        device = PDFPageAggregator(manager, laparams=None)
+        interpreter = PDFPageInterpreter(manager, device)
+        for page_number, page in enumerate(PDFPage.create_pages(document)):
+            if pages is not None and page_number not in pages:
+                continue
+            interpreter.process_page(page)
+            yield page_number, device.get_result()
+
+
+def _overlaps(a, b, margin=0.):
+    return a[0] - margin <= b[2] and b[0] - margin <= a[2] and a[1] - margin <= b[3] and b[1] - margin <= a[3]
+
+
+def _contains(a, b, margin=0.):
+    return a[0] - margin <= b[0] and b[2] <= a[2] + margin and a[1] - margin <= b[1] and b[3] <= a[3] + margin
+
+
+def connected_boxes(boxes, margin=0.):
+    """
+    Labels the connected components of boxes that lie within the margin of one another.
+
+    The boxes are swept in order of their left edge, so each is only compared with the boxes
+    whose right edge the sweep has not passed yet, and touching boxes are joined by union-find.
+
+    :param boxes: The (x0, y0, x1, y1) boxes.
+    :param margin: The gap below which two boxes touch.
+
+    :return: An array holding the label of every box, the smallest index in its component.
+    """
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4).tolist()
+    parent = list(range(len(boxes)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    active = []
+    for i in sorted(range(len(boxes)), key=lambda i: boxes[i][0]):
+        x0, y0, x1, y1 = boxes[i]
+        active = [j for j in active if boxes[j][2] + margin >= x0]
+        for j in active:
+            if boxes[j][1] - margin <= y1 and y0 - margin <= boxes[j][3]:
+                a, b = find(i), find(j)
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+        active.append(i)
+    return np.array([find(i) for i in range(len(boxes))], dtype=int)
+
+
+def find_regions(boxes, margin=10.):
+    """
+    Groups bounding boxes that lie within the margin of one another into circuit regions.
+
+    The bounding box of a group can reach boxes that none of its members touch, so groups are
+    merged again until no two regions are within the margin, whatever order the boxes come in.
+
+    :param boxes: The (x0, y0, x1, y1) bounding boxes of the primitives on a page.
+    :param margin: The gap below which two boxes belong to the same circuit.
+
+    :return: The (x0, y0, x1, y1) bounding boxes of the regions.
+    """
+    regions = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    while True:
+        labels = connected_boxes(regions, margin)
+        groups = np.unique(labels)
+        if len(groups) == len(regions):
+            break
+        regions = np.array([np.concatenate([regions[labels == label, :2].min(axis=0),
+                                            regions[labels == label, 2:].max(axis=0)]) for label in groups])
+    return sorted([tuple(float(value) for value in region) for region in regions],
+                  key=lambda region: (-region[3], region[0]))
+
+
+def detect_bbox(layout, margin=10.):
+    """
+    Finds the region of a page holding the most drawing primitives.
+
+    :param layout: The LTPage from a PDFPageAggregator without LAParams.
+    :param margin: The gap below which primitives belong to the same circuit.
+
+    :return: The (x0, y0, x1, y1) bounding box of the region, or None if the page has no primitives.
+    """
+    boxes = _region_boxes(layout)
+    regions = find_regions(boxes, margin)
+    if len(regions) == 0:
+        return None
+    return max(regions, key=lambda region: sum(1 for box in boxes if _overlaps(region, box)))
+
+
+def _parse_page(job):
+    """
+    Parses each of the circuit regions of a single page.
+
+    :param job: The path to the pdf, the page number, the regions on the page, the margin around
+        them, whether to skip layout analysis and the page's LTPage if it was already interpreted.
+
+    :return: The ParsedCircuits of the page.
+    """
+    path_to_pdf, page_number, regions, margin, fast, layout = job
+
+    if fast:
+        if layout is None:
+            page_number, layout = next(iter_page_layouts(path_to_pdf, [page_number]))
+        elements = None
+    else:
+        pdf = pdfquery.PDFQuery(path_to_pdf)
+        elements = [element for element in pdf.get_tree(page_number).getroot().iter(tag=etree.Element)
+                    if 'x0' in element.attrib.keys() and element.tag != 'LTPage']
+
+    circuits = []
+    for region in regions:
+        if fast:
+            in_region = extract_records(layout, region, margin)
+        else:
+            # keep document order so the walk sees the same sequence as parse_circuit
+            in_region = [element for element in elements if (
+                _contains if element.tag.startswith('LTText') else _overlaps
+            )(region, tuple(float(element.attrib[key]) for key in ['x0', 'y0', 'x1', 'y1']), margin)]
+        wires, controls, cnots = walk_elements(in_region)
+        builder, iterations, calls = emit_qasm(wires)
+        if builder.qasm:
+            circuits.append(ParsedCircuit(page=page_number, bbox=region, qasm=builder.program))
+    return circuits
+
+
+def parse_circuits(path_to_pdf="examples/pdf/Circuits.pdf", pages=None, processes=None, margin=10., fast=False):
+    """
+    Parses every circuit in a pdf of any number of pages.
+
+    Pages are interpreted lazily and only those with drawing primitives go through
+    layout analysis. Each group of nearby primitives is parsed as its own circuit, so
+    text and page numbers outside of them are ignored.
+
+    :param path_to_pdf: The path to the pdf.
+    :param pages: The page numbers to parse, defaults to every page.
+    :param processes: The number of worker processes to parse pages with, defaults to parsing in this process.
+    :param margin: The gap below which primitives belong to the same circuit.
+    :param fast: Whether to skip pdfminer's layout analysis and work from the characters and primitives.
+
+    :return: The ParsedCircuits in page order.
+    """
+    # pages interpreted here are only reused in this process, workers interpret their own
+    jobs = ((path_to_pdf, page_number, regions, margin, fast, None if processes else layout)
+            for page_number, layout in iter_page_layouts(path_to_pdf, pages)
+            for regions in [find_regions(_region_boxes(layout), margin)]
+            if len(regions) > 0)
+
+    if processes:
+        with Pool(processes) as pool:
+            return [circuit for circuits in pool.imap(_parse_page, jobs) for circuit in circuits]
+    return [circuit for job in jobs for circuit in _parse_page(job)]
@@ -0,0 +1,219 @@
+import hashlib
+import sqlite3
+import threading
+import time
+import os
+
+from collections import OrderedDict
+
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '.cache', 'results.sqlite')
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    Hashes the contents of a file.
+
+    :param path: The path to the file.
+    :param chunk_size: The number of bytes to read at a time.
+    :return: The hex SHA-256 of the file.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_key(path, version, *options):
+    """
+    Builds the cache key of a conversion: the SHA-256 of the input's bytes, the version of
+    the parser or model that converts it and any options that change its output.
+
+    :param path: The path to the input pdf or image.
+    :param version: The parser or model version.
+    :param options: Further options the result depends on.
+    :return: The key.
+    """
+    return ':'.join([file_digest(path), str(version)] + [str(option) for option in options])
+
+
+class ResultCache(object):
+    """
+    A two tier cache of conversion results: a bounded in-memory LRU in front of a
+    sqlite file that is trimmed back to max_disk_bytes, least recently used first.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, max_entries=1024, max_disk_bytes=64 * 2 ** 20):
+        """
+        :param path: The sqlite file of the on-disk tier, or None to keep results in memory only.
+        :param max_entries: The number of results held in memory.
+        :param max_disk_bytes: The total size of the results held on disk.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._digests = {}
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS results '
+                '(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+            # the size of every result in the file, whichever process wrote it, kept up to date by
+            # put and clear inside their write transactions so the limit covers the whole file
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS usage (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL)'
+            )
+            self._db.execute(
+                'INSERT OR IGNORE INTO usage (id, bytes) SELECT 0, COALESCE(SUM(size), 0) FROM results'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS digests '
+                '(path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, digest TEXT NOT NULL)'
+            )
+
+    def _add_usage(self, delta):
+        self._db.execute('UPDATE usage SET bytes = bytes + ? WHERE id = 0', (delta,))
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def file_digest(self, path):
+        """
+        Hashes a file once per version, e.g. a model, reusing the digest while its size and
+        modification time are unchanged.
+
+        :param path: The path to the file.
+        :return: The hex SHA-256 of the file.
+        """
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        version = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            if self._digests.get(path, (None,))[:2] == version:
+                return self._digests[path][2]
+            if self._db is not None:
+                row = self._db.execute(
+                    'SELECT digest FROM digests WHERE path = ? AND size = ? AND mtime_ns = ?', (path,) + version
+                ).fetchone()
+                if row is not None:
+                    self._digests[path] = version + (row[0],)
+                    return row[0]
+        digest = file_digest(path)
+        with self._lock:
+            self._digests[path] = version + (digest,)
+            if self._db is not None:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO digests (path, size, mtime_ns, digest) VALUES (?, ?, ?, ?)',
+                    (path,) + version + (digest,)
+                )
+        return digest
+
+    def get(self, key):
+        """
+        Looks a result up in memory, then on disk.
+
+        :param key: The key from content_key.
+        :return: The cached result, or None.
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+            if self._db is not None:
+                row = self._db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    self._db.execute('UPDATE results SET accessed = ? WHERE key = ?', (time.time(), key))
+                    self._remember(key, row[0])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """
+        Stores a result in both tiers, evicting the least recently used results on disk
+        once they exceed max_disk_bytes.
+
+        :param key: The key from content_key.
+        :param value: The result string.
+        """
+        with self._lock:
+            self._remember(key, value)
+            if self._db is None:
+                return
+            size = len(key) + len(value.encode('utf-8'))
+            # other processes may write to the same file, so the usage is read and trimmed
+            # under the write lock
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                replaced = self._db.execute('SELECT size FROM results WHERE key = ?', (key,)).fetchone()
+                self._db.execute(
+                    'INSERT OR REPLACE INTO results (key, value, size, accessed) VALUES (?, ?, ?, ?)',
+                    (key, value, size, time.time())
+                )
+                self._add_usage(size - (replaced[0] if replaced is not None else 0))
+                total = self._db.execute('SELECT bytes FROM usage WHERE id = 0').fetchone()[0]
+                while total > self.max_disk_bytes:
+                    oldest = self._db.execute(
+                        'SELECT key, size FROM results ORDER BY accessed LIMIT 64').fetchall()
+                    if len(oldest) == 0:
+                        self._db.execute('UPDATE usage SET bytes = 0 WHERE id = 0')
+                        break
+                    for old_key, old_size in oldest:
+                        if total <= self.max_disk_bytes:
+                            break
+                        self._db.execute('DELETE FROM results WHERE key = ?', (old_key,))
+                        self._add_usage(-old_size)
+                        total -= old_size
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+
+    def clear(self):
+        """
+        Empties both tiers.
+        """
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute('BEGIN IMMEDIATE')
+                self._db.execute('DELETE FROM results')
+                self._db.execute('UPDATE usage SET bytes = 0 WHERE id = 0')
+                self._db.execute('COMMIT')
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+_shared = None
+
+
+def shared_cache():
+    """
+    The cache shared by the pdf parser and the image classifier, opened on first use.
+
+    :return: The ResultCache at DEFAULT_PATH.
+    """
+    global _shared
+    if _shared is None:
+        _shared = ResultCache()
+    return _shared
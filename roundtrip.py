@@ -0,0 +1,206 @@
+import numpy as np
+import contextlib
+import tempfile
+import pathlib
+import getopt
+import signal
+import json
+import time
+import sys
+import io
+
+from multiprocessing import Pool
+
+from qcircuit_parse import parse_circuit
+from qasm_utils import same_circuit
+from unitary import functional_accuracy
+
+
+HELP_STRING = "Usage: python roundtrip.py [--data_dir examples/gen] [--processes 4] [--fast] [--step 1] " \
+              "[--timeout 30] [--slowest 10] [--min_accuracy 0.99] [--output roundtrip.json]"
+
+
+def _timeout(signum, frame):
+    raise TimeoutError()
+
+
+def _roundtrip(job):
+    """
+    Parses one pdf and compares it with its reference QASM.
+
+    :param job: The circuit number, the paths to its pdf, reference QASM and scratch .xml,
+        whether to use the fast path and the timeout in seconds.
+    :return: A dict with the circuit, latency, whether it matched, whether it implements the
+        same unitary and any error.
+    """
+    num, path_to_pdf, path_to_qasm, path_to_xml, fast, timeout = job
+    with open(path_to_qasm, 'r') as f:
+        reference = f.read()
+
+    qasm = None
+    error = None
+    if timeout:
+        signal.signal(signal.SIGALRM, _timeout)
+        signal.alarm(timeout)
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            qasm = parse_circuit(path_to_pdf, path_to_xml, fast=fast)
+    except TimeoutError:
+        error = f'timed out after {timeout}s'
+    except Exception as e:
+        error = repr(e)
+    finally:
+        latency = time.perf_counter() - start
+        if timeout:
+            signal.alarm(0)
+
+    equivalent = False
+    if qasm is not None:
+        try:
+            equivalent = functional_accuracy([qasm], [reference]) == 1.
+        except ValueError:  # gates that cannot be simulated, e.g. custom ones
+            pass
+
+    return {
+        'circuit': num,
+        'latency_ms': 1000 * latency,
+        'matched': qasm is not None and same_circuit(qasm, reference),
+        'equivalent': equivalent,
+        'error': error
+    }
+
+
+def find_pairs(data_dir='examples/gen'):
+    """
+    Finds the (circuit_N.pdf, circuit_N.qasm) pairs of a generated corpus.
+
+    :param data_dir: The folder of the corpus.
+    :return: A sorted list of (N, path to pdf, path to QASM).
+    """
+    pairs = []
+    for pdf in pathlib.Path(data_dir).glob('circuit_*.pdf'):
+        qasm = pdf.with_suffix('.qasm')
+        if qasm.exists():
+            pairs.append((int(pdf.stem.split('_')[1]), str(pdf), str(qasm)))
+    return sorted(pairs)
+
+
+def run(data_dir='examples/gen', processes=None, fast=False, step=1, timeout=30, slowest=10):
+    """
+    Parses every generated pdf in a worker pool and checks it against its reference QASM.
+
+    :param data_dir: The folder of the corpus.
+    :param processes: The number of worker processes, defaults to one per cpu.
+    :param fast: Whether to parse with the fast path of parse_circuit.
+    :param step: Only check every step-th circuit.
+    :param timeout: The seconds a single parse may take, or 0 for no limit.
+    :param slowest: The number of slowest circuits to report.
+    :return: The report.
+    """
+    pairs = find_pairs(data_dir)[::step]
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as folder:
+        jobs = [(num, pdf, qasm, f'{folder}/{num}.xml', fast, timeout) for num, pdf, qasm in pairs]
+        with Pool(processes) as pool:
+            results = list(pool.imap_unordered(_roundtrip, jobs, chunksize=16))
+    elapsed = time.perf_counter() - start
+
+    results = sorted(results, key=lambda result: result['circuit'])
+    latencies = np.array([result['latency_ms'] for result in results])
+    matched = sum(result['matched'] for result in results)
+    return {
+        'data_dir': data_dir,
+        'fast': fast,
+        'circuits': len(results),
+        'matched': matched,
+        'accuracy': matched / len(results) if len(results) else None,
+        'functional_accuracy': sum(result['equivalent'] for result in results) / len(results) if len(results) else None,
+        'errors': sum(result['error'] is not None for result in results),
+        'wall_time_s': elapsed,
+        'latency_ms': {
+            'mean': float(np.mean(latencies)),
+            'p50': float(np.percentile(latencies, 50)),
+            'p90': float(np.percentile(latencies, 90)),
+            'p99': float(np.percentile(latencies, 99)),
+            'max': float(np.max(latencies))
+        } if len(results) else None,
+        'slowest': sorted(results, key=lambda result: -result['latency_ms'])[:slowest],
+        'failed': [result for result in results if not result['matched']]
+    }
+
+
+def print_report(report, limit=20):
+    """
+    Prints the accuracy, latency percentiles and the slowest and failed circuits of a report.
+    """
+    print(f"\n{report['matched']}/{report['circuits']} circuits matched "
+          f"({100 * (report['accuracy'] or 0):.2f}%), {100 * (report['functional_accuracy'] or 0):.2f}% "
+          f"functionally equivalent, {report['errors']} errors, "
+          f"{report['wall_time_s']:.1f}s wall time")
+    if report['latency_ms'] is not None:
+        print("latency (ms): " + ", ".join(f"{name} {value:.2f}" for name, value in report['latency_ms'].items()))
+    print("\nslowest:")
+    for result in report['slowest']:
+        print(f"  circuit_{result['circuit']}: {result['latency_ms']:.2f} ms")
+    if len(report['failed']) > 0:
+        print(f"\nfailed ({len(report['failed'])}):")
+        for result in report['failed'][:limit]:
+            print(f"  circuit_{result['circuit']}: {result['error'] or 'QASM differs'}")
+
+
+def main(argv):
+    data_dir = 'examples/gen'
+    processes = None
+    fast = False
+    step = 1
+    timeout = 30
+    slowest = 10
+    min_accuracy = None
+    output = 'roundtrip.json'
+
+    try:
+        opts, args = getopt.getopt(
+            argv,
+            "h",
+            ["help", "data_dir=", "processes=", "fast", "step=", "timeout=", "slowest=", "min_accuracy=",
+             "output="]
+        )
+    except getopt.GetoptError:
+        print(HELP_STRING)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ["-h", "--help"]:
+            print(HELP_STRING)
+            sys.exit()
+        elif opt == "--data_dir":
+            data_dir = arg
+        elif opt == "--processes":
+            processes = int(arg)
+        elif opt == "--fast":
+            fast = True
+        elif opt == "--step":
+            step = int(arg)
+        elif opt == "--timeout":
+            timeout = int(arg)
+        elif opt == "--slowest":
+            slowest = int(arg)
+        elif opt == "--min_accuracy":
+            min_accuracy = float(arg)
+        elif opt == "--output":
+            output = arg
+
+    report = run(data_dir, processes, fast, step, timeout, slowest)
+    print_report(report)
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    # lets CI fail the run when a change costs accuracy
+    if min_accuracy is not None and (report['accuracy'] or 0) < min_accuracy:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
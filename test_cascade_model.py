@@ -0,0 +1,48 @@
+import tensorflow as tf
+import numpy as np
+import json
+import os
+
+from cascade_model import Cascade, build_structure_model, drop_untrained_buckets
+from images import IMAGE_SIZE
+from test_data_generation import circuit_at, circuit_structure
+
+
+def test_drop_untrained_buckets():
+    buckets = [{'free': 2}, {'free': 2}, {'free': 4}]
+    train_examples = [('a.jpg', 0, (0, 1)), ('b.jpg', 2, (0, 1, 2, 3))]
+    val_examples = [('c.jpg', 1, (1, 0)), ('d.jpg', 2, (3, 2, 1, 0))]
+
+    train_examples, val_examples, kept = drop_untrained_buckets(train_examples, val_examples, buckets)
+
+    assert kept == [{'free': 2}, {'free': 4}]
+    assert [bucket for path, bucket, gates in train_examples] == [0, 1]
+    assert [bucket for path, bucket, gates in val_examples] == [-1, 1]
+
+
+def test_predict_bucket_without_head(tmp_path):
+    # a structure model that always picks the second bucket, which has free cells but no head
+    model = build_structure_model(2)
+    dense = model.get_layer('bucket')
+    kernel, bias = dense.get_weights()
+    dense.set_weights([np.zeros_like(kernel), np.array([0., 5.], dtype=bias.dtype)])
+    with open(os.path.join(tmp_path, 'structure.tflite'), 'wb') as f:
+        f.write(tf.lite.TFLiteConverter.from_keras_model(model).convert())
+
+    depth, qubits, combination, orientation, gates = circuit_structure(circuit_at(0, 4, 2))
+    layout = {'depth': depth, 'combination': list(combination), 'orientation': list(orientation)}
+    with open(os.path.join(tmp_path, 'cascade.json'), 'w') as f:
+        json.dump({
+            'qubits': qubits,
+            'max_circuit_depth': 4,
+            'buckets': [dict(layout, free=len(gates), model='bucket_0.tflite'),
+                        dict(layout, free=len(gates), model=None)],
+            'digests': {}
+        }, f)
+
+    prediction = Cascade(str(tmp_path)).predict(np.zeros((1,) + IMAGE_SIZE + (3,), dtype=np.float32))
+
+    assert prediction['bucket'] == 1
+    assert prediction['confidence'] == 0.
+    assert len(prediction['gates']) == len(gates)
+    assert 'OPENQASM' in prediction['qasm']
@@ -1,4 +1,7 @@
 import os
+import sys
+import getopt
+import random
 import pathlib
 from PIL import Image
 import os.path
@@ -8,10 +11,18 @@ from circuit_builder import Builder
 
 from pdf2image import convert_from_path
 
-from math import floor
+from math import floor, perm
 from copy import deepcopy
+from bisect import bisect_right
 from itertools import combinations
-from functools import reduce
+from functools import reduce, lru_cache
+
+SINGLE_QUBIT_GATES = list(filter(lambda g: g != 'cx', GATES))
+
+ORIENTATIONS = ['up', 'down']
+
+HELP_STRING = "Usage: python test_data_generation.py [--max_depth 4] [--qubits 2] [--folder examples/gen] " \
+              "[--start 0] [--stop N] [--sample K] [--seed 123]"
 
 
 def permutations(iterable, r=None):
@@ -56,14 +67,71 @@ def convert_pdf_to_image(path_to_pdf="examples/pdf/Circuits.pdf", path_to_image=
         page.save(path_to_image, 'JPEG')
 
 
-def generate_pdfs(max_circuit_depth=3, qubits=2, folder="examples/gen"):
+def build_tex(circuit, builder):
     """
-    Generates LaTeX, pdfs and images for the permutations of supported gates on the
-    given number of qubits with up to the provided circuit depth.
+    Writes the LaTeX for a circuit grid into the builder by depth first traversal.
 
-    :param circuit_depth: The max depth of the circuits to generate.
-    :param qubits: The number of qubits in the circuits to generate.
-    :param folder: The folder to hold the outputs.
+    :param circuit: The circuit as a list of wires, each a list of Gates.
+    :param builder: The Builder to write the LaTeX into.
+    :return: The builder.
+    """
+    wire = 0
+    i = 0
+    while wire < len(circuit) and i < len(circuit[0]):
+        gate = circuit[wire][i]
+        if 'cx' not in gate['name']:
+            getattr(builder, gate['name'])(wire, tex_only=True)
+        elif gate['source'] == wire:
+            builder.tex_cx_source('up' if gate['source'] < gate['target'] else 'down')
+        elif gate['target'] == wire:
+            builder.tex_cx_target()
+        i += 1
+        if i >= len(circuit[0]):
+            builder.new_tex_wire()
+            wire += 1
+            i = 0
+    return builder
+
+
+def build_qasm(circuit, builder):
+    """
+    Writes the QASM for a circuit grid into the builder by breadth first traversal.
+
+    :param circuit: The circuit as a list of wires, each a list of Gates.
+    :param builder: The Builder to write the QASM into.
+    :return: The builder.
+    """
+    max_depth = 0
+    for w in range(len(circuit)):
+        if len(circuit[w]) > max_depth:
+            max_depth = len(circuit[w])
+
+    i = 0
+    while i < max_depth:
+        seen_cxs = []
+        wire = 0
+        while wire < len(circuit):
+            if i < len(circuit[wire]):
+                gate = circuit[wire][i]
+                if 'cx' not in gate['name']:
+                    getattr(builder, gate['name'])(wire, qasm_only=True)
+                elif ((gate['source'] == wire or gate['target'] == wire)
+                      and (str(gate['source']) + ':' + str(gate['target']) not in seen_cxs)):
+                    seen_cxs.append(str(gate['source']) + ':' + str(gate['target']))
+                    builder.cx(gate['source'], gate['target'])
+            wire += 1
+        i += 1
+    return builder
+
+
+def enumerate_circuits(max_circuit_depth=3, qubits=2):
+    """
+    Enumerates the permutations of supported gates on the given number of qubits
+    with up to the provided circuit depth.
+
+    :param max_circuit_depth: The max depth of the circuits to enumerate.
+    :param qubits: The number of qubits in the circuits to enumerate.
+    :return: The circuits, each a list of wires holding a list of Gates.
     """
     circuits = []
 
@@ -142,68 +210,274 @@ def generate_pdfs(max_circuit_depth=3, qubits=2, folder="examples/gen"):
                             circuit = place_single_qubit_gate(Gate(name=permuted_gate), pg_index, circuit)
                         circuits.append(circuit)
 
-    builders = []
+    return circuits
 
-    # depth first traversal for LaTeX generation
-    for num, circuit in enumerate(circuits):
-        builder = Builder(pad=False)
-        builders.append(builder)
-        wire = 0
-        i = 0
-        while wire < len(circuit) and i < len(circuit[0]):
+
+def _cnot_grid(combination, orientation, circuit_depth, qubits):
+    """
+    Places CNOTs on an empty circuit as enumerate_circuits does.
+
+    :param combination: The positions of the CNOTs, wire pair * circuit_depth + column.
+    :param orientation: 'up' or 'down' for every CNOT.
+    :param circuit_depth: The depth of the circuit.
+    :param qubits: The number of qubits.
+    :return: The circuit holding identities and CNOTs.
+    """
+    circuit = [[Gate(name='I', index=i) for i in range(circuit_depth)] for wire in range(qubits)]
+    for source_index, direction in zip(combination, orientation):
+        pair = floor(source_index / circuit_depth)
+        column = source_index % circuit_depth
+        source, target = (pair, pair + 1) if direction == 'up' else (pair + 1, pair)
+        cnot = Gate(name='cx', source_index=column, source=source, index=column, target=target)
+        circuit[source][column] = cnot
+        circuit[target][column] = cnot
+    return circuit
+
+
+def _free_cells(combination, circuit_depth, qubits):
+    """
+    Counts the cells left for single qubit gates once the CNOTs at these positions are placed.
+    """
+    covered = set()
+    for source_index in combination:
+        pair = floor(source_index / circuit_depth)
+        covered.update([(pair, source_index % circuit_depth), (pair + 1, source_index % circuit_depth)])
+    return circuit_depth * qubits - len(covered)
+
+
+def _unrank_permutation(pool, r, rank):
+    """
+    Finds the rank-th r-permutation of pool in the order permutations yields them.
+    """
+    pool = list(pool)
+    chosen = []
+    for i in range(r):
+        block = perm(len(pool) - 1, r - i - 1)
+        chosen.append(pool.pop(rank // block))
+        rank %= block
+    return tuple(chosen)
+
+
+def _rank_permutation(pool, chosen):
+    """
+    Finds the position of a permutation of elements of pool in the order permutations yields them.
+    """
+    pool = list(pool)
+    rank = 0
+    for i, element in enumerate(chosen):
+        rank += pool.index(element) * perm(len(pool) - 1, len(chosen) - i - 1)
+        pool.remove(element)
+    return rank
+
+
+@lru_cache(maxsize=None)
+def _block(circuit_depth, length, qubits):
+    """
+    Lays out the circuits of one depth and number of CNOTs in enumeration order.
+
+    Each placement of CNOTs is followed by its orientations and then by the permutations of single
+    qubit gates over the free cells, so it covers orientations * perm(gates, free cells) ids. Since
+    permutations(ORIENTATIONS, length) is empty beyond two CNOTs, only blocks of one or two CNOTs are
+    non-empty and listing their placements stays quadratic in the number of positions.
+
+    :param circuit_depth: The depth of the circuits.
+    :param length: The number of CNOTs.
+    :param qubits: The number of qubits.
+    :return: The placements, the first id of every placement relative to the block and the size of the block.
+    """
+    orientations = perm(len(ORIENTATIONS), length) if length <= len(ORIENTATIONS) else 0
+    # CNOTs cover at most two cells each and every other cell needs a distinct gate
+    if orientations == 0 or circuit_depth * qubits - 2 * length > len(SINGLE_QUBIT_GATES):
+        return [], [], 0
+
+    placements = []
+    offsets = []
+    total = 0
+    for combination in combinations(range(circuit_depth * (qubits - 1)), length):
+        size = orientations * perm(len(SINGLE_QUBIT_GATES), _free_cells(combination, circuit_depth, qubits))
+        if size > 0:
+            placements.append(combination)
+            offsets.append(total)
+            total += size
+    return placements, offsets, total
+
+
+def _blocks(max_circuit_depth, qubits):
+    """
+    Yields the depth, number of CNOTs and size of every block in enumeration order.
+    """
+    for circuit_depth in range(2, max_circuit_depth):
+        for length in range(1, circuit_depth * (qubits - 1)):
+            yield circuit_depth, length, _block(circuit_depth, length, qubits)[2]
+
+
+def circuit_from_structure(circuit_depth, qubits, combination, orientation, gates):
+    """
+    Builds a circuit from its CNOT layout and the single qubit gates filling the remaining cells.
+
+    :param circuit_depth: The depth of the circuit.
+    :param qubits: The number of qubits.
+    :param combination: The positions of the CNOTs, wire pair * circuit_depth + column.
+    :param orientation: 'up' or 'down' for every CNOT.
+    :param gates: The single qubit gates of the free cells, wire by wire.
+    :return: The circuit as a list of wires, each a list of Gates.
+    """
+    circuit = _cnot_grid(combination, orientation, circuit_depth, qubits)
+    cells = [(wire, i) for wire in range(qubits) for i in range(circuit_depth) if circuit[wire][i]['name'] != 'cx']
+    for (wire, i), name in zip(cells, gates):
+        circuit[wire][i] = Gate(name=name, index=i)
+    return circuit
+
+
+def circuit_structure(circuit):
+    """
+    Splits a circuit into its CNOT layout and its single qubit gates, the inverse of circuit_from_structure.
+
+    :param circuit: The circuit as a list of wires, each a list of Gates.
+    :return: The depth, number of qubits, CNOT positions, CNOT orientations and single qubit gates.
+    """
+    qubits = len(circuit)
+    circuit_depth = len(circuit[0])
+    cnots = {}
+    gates = []
+    for wire in range(qubits):
+        for i in range(circuit_depth):
             gate = circuit[wire][i]
-            if 'cx' not in gate['name']:
-                getattr(builder, gate['name'])(wire, tex_only=True)
-            elif gate['source'] == wire:
-                builder.tex_cx_source('up' if gate['source'] < gate['target'] else 'down')
-            elif gate['target'] == wire:
-                builder.tex_cx_target()
-            i += 1
-            if i >= len(circuit[0]):
-                builder.new_tex_wire()
-                wire += 1
-                i = 0
+            if gate['name'] == 'cx':
+                pair = min(gate['source'], gate['target'])
+                cnots[pair * circuit_depth + i] = 'up' if gate['source'] < gate['target'] else 'down'
+            else:
+                gates.append(gate['name'])
+
+    combination = tuple(sorted(cnots))
+    orientation = tuple(cnots[source_index] for source_index in combination)
+    return circuit_depth, qubits, combination, orientation, tuple(gates)
 
-    # breadth first traversal for QASM generation
-    for num, circuit in enumerate(circuits):
-        builder = builders[num]
 
-        max_depth = 0
-        for w in range(len(circuit)):
-            if len(circuit[w]) > max_depth:
-                max_depth = len(circuit[w])
+def count_circuits(max_circuit_depth=3, qubits=2):
+    """
+    Counts the circuits enumerate_circuits lists, without building them.
+
+    :param max_circuit_depth: The max depth of the circuits.
+    :param qubits: The number of qubits in the circuits.
+    :return: The number of circuits.
+    """
+    return sum(size for circuit_depth, length, size in _blocks(max_circuit_depth, qubits))
+
+
+def circuit_at(num, max_circuit_depth=3, qubits=2):
+    """
+    Builds the circuit with the given id, the same as enumerate_circuits(max_circuit_depth, qubits)[num]
+    without enumerating the circuits before it. Ids do not depend on max_circuit_depth, which only
+    bounds the space.
+
+    :param num: The id of the circuit.
+    :param max_circuit_depth: The max depth of the circuits.
+    :param qubits: The number of qubits in the circuits.
+    :raises: IndexError
+    :return: The circuit as a list of wires, each a list of Gates.
+    """
+    if num < 0:
+        raise IndexError(f'Circuit ids start at 0, got {num}.')
+    rank = num
+    for circuit_depth, length, size in _blocks(max_circuit_depth, qubits):
+        if rank >= size:
+            rank -= size
+            continue
+
+        placements, offsets, total = _block(circuit_depth, length, qubits)
+        p = bisect_right(offsets, rank) - 1
+        combination = placements[p]
+        rank -= offsets[p]
+        free = _free_cells(combination, circuit_depth, qubits)
+        orientation = _unrank_permutation(ORIENTATIONS, length, rank // perm(len(SINGLE_QUBIT_GATES), free))
+        gates = _unrank_permutation(SINGLE_QUBIT_GATES, free, rank % perm(len(SINGLE_QUBIT_GATES), free))
+
+        return circuit_from_structure(circuit_depth, qubits, combination, orientation, gates)
+    raise IndexError(f'There are only {num - rank} circuits of depth below {max_circuit_depth} on {qubits} qubits.')
+
+
+def circuit_id(circuit):
+    """
+    Finds the id of a circuit, the inverse of circuit_at.
+
+    :param circuit: The circuit as a list of wires, each a list of Gates.
+    :raises: ValueError
+    :return: The id of the circuit.
+    """
+    circuit_depth, qubits, combination, orientation, gates = circuit_structure(circuit)
+    placements, offsets, total = _block(circuit_depth, len(combination), qubits)
+    if combination not in placements or len(set(gates)) != len(gates) \
+            or not set(gates).issubset(SINGLE_QUBIT_GATES):
+        raise ValueError('The circuit is not one enumerate_circuits lists.')
+
+    num = sum(size for d, length, size in _blocks(circuit_depth + 1, qubits)
+              if (d, length) < (circuit_depth, len(combination)))
+    return num + offsets[placements.index(combination)] \
+        + _rank_permutation(ORIENTATIONS, orientation) * perm(len(SINGLE_QUBIT_GATES), len(gates)) \
+        + _rank_permutation(SINGLE_QUBIT_GATES, gates)
+
+
+def sample_circuit_ids(k, max_circuit_depth=3, qubits=2, seed=None):
+    """
+    Draws circuit ids uniformly without replacement, without enumerating the circuits.
+
+    :param k: The number of ids.
+    :param max_circuit_depth: The max depth of the circuits.
+    :param qubits: The number of qubits in the circuits.
+    :param seed: The seed.
+    :return: The ids.
+    """
+    return random.Random(seed).sample(range(count_circuits(max_circuit_depth, qubits)), k)
 
+
+def render_circuit(builder, num, folder="examples/gen"):
+    """
+    Writes the QASM and LaTeX of a circuit, runs pdflatex and converts the pdf to an image.
+
+    :param builder: The Builder holding the circuit.
+    :param num: The id of the circuit.
+    :param folder: The folder to hold the outputs.
+    """
+    builder.print_qasm_file(f"{folder}/circuit_{num}.qasm")
+    builder.print_tex_file(f"{folder}/circuit_{num}.tex")
+    os.system(f"cd {folder} && pdflatex circuit_{num}.tex")
+    if not pathlib.Path(f"{folder}/{num}").is_dir():
+        os.mkdir(f"{folder}/{num}")
+        convert_pdf_to_image(f"{folder}/circuit_{num}.pdf", f"{folder}/{num}/circuit_{num}.jpg")
+    else:
         i = 0
-        while i < max_depth:
-            seen_cxs = []
-            wire = 0
-            while wire < len(circuit):
-                if i < len(circuit[wire]):
-                    gate = circuit[wire][i]
-                    if 'cx' not in gate['name']:
-                        getattr(builder, gate['name'])(wire, qasm_only=True)
-                    elif ((gate['source'] == wire or gate['target'] == wire)
-                          and (str(gate['source']) + ':' + str(gate['target']) not in seen_cxs)):
-                        seen_cxs.append(str(gate['source']) + ':' + str(gate['target']))
-                        builder.cx(gate['source'], gate['target'])
-                wire += 1
+        while os.path.exists(f"{folder}/{num}/circuit_{num + i}.jpg"):
             i += 1
+        convert_pdf_to_image(f"{folder}/circuit_{num}.pdf", f"{folder}/{num}/circuit_{num + i}.jpg")
+
+
+def generate_pdfs(max_circuit_depth=3, qubits=2, folder="examples/gen", ids=None):
+    """
+    Generates LaTeX, pdfs and images for the permutations of supported gates on the
+    given number of qubits with up to the provided circuit depth.
+
+    :param max_circuit_depth: The max depth of the circuits to generate.
+    :param qubits: The number of qubits in the circuits to generate.
+    :param folder: The folder to hold the outputs.
+    :param ids: The ids of the circuits to generate, e.g. a range for one shard, defaults to all of them.
+    """
+    if ids is None:
+        ids = range(count_circuits(max_circuit_depth, qubits))
+
+    builders = {}
+
+    for num in ids:
+        builder = Builder(pad=False)
+        builders[num] = builder
+        circuit = circuit_at(num, max_circuit_depth, qubits)
+        build_tex(circuit, builder)
+        build_qasm(circuit, builder)
 
     # write files
-    for num, circuit in enumerate(circuits):
-        builder = builders[num]
-
-        builder.print_qasm_file(f"{folder}/circuit_{num}.qasm")
-        builder.print_tex_file(f"{folder}/circuit_{num}.tex")
-        os.system(f"cd {folder} && pdflatex circuit_{num}.tex")
-        if not pathlib.Path(f"{folder}/{num}").is_dir():
-            os.mkdir(f"{folder}/{num}")
-            convert_pdf_to_image(f"{folder}/circuit_{num}.pdf", f"{folder}/{num}/circuit_{num}.jpg")
-        else:
-            i = 0
-            while os.path.exists(f"{folder}/{num}/circuit_{num + i}.jpg"):
-                i += 1
-            convert_pdf_to_image(f"{folder}/circuit_{num}.pdf", f"{folder}/{num}/circuit_{num + i}.jpg")
+    for num, builder in builders.items():
+        render_circuit(builder, num, folder)
+
 
 def crop():
     for item in os.listdir("examples/gen"):
@@ -217,6 +491,53 @@ def crop():
                     im_crop.save(full_path)
 
 
-if __name__ == "__main__":
-    generate_pdfs(max_circuit_depth=4)
+def main(argv):
+    max_depth = 4
+    qubits = 2
+    folder = "examples/gen"
+    start = 0
+    stop = None
+    sample = None
+    seed = None
+
+    try:
+        opts, args = getopt.getopt(
+            argv, "h", ["help", "max_depth=", "qubits=", "folder=", "start=", "stop=", "sample=", "seed="]
+        )
+    except getopt.GetoptError:
+        print(HELP_STRING)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ["-h", "--help"]:
+            print(HELP_STRING)
+            sys.exit()
+        elif opt == "--max_depth":
+            max_depth = int(arg)
+        elif opt == "--qubits":
+            qubits = int(arg)
+        elif opt == "--folder":
+            folder = arg
+        elif opt == "--start":
+            start = int(arg)
+        elif opt == "--stop":
+            stop = int(arg)
+        elif opt == "--sample":
+            sample = int(arg)
+        elif opt == "--seed":
+            seed = int(arg)
+
+    total = count_circuits(max_depth, qubits)
+    if sample is not None:
+        ids = sorted(sample_circuit_ids(sample, max_depth, qubits, seed))
+    else:
+        # shards are plain id ranges, so machines can split the work without talking to each other
+        ids = range(start, total if stop is None else min(stop, total))
+    print(f"Generating {len(ids)} of {total} circuits")
+
+    generate_pdfs(max_depth, qubits, folder, ids)
     crop()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
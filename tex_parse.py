@@ -0,0 +1,232 @@
+import os
+import re
+
+from circuit_builder import Builder
+from qcircuit_parse import parse_circuit
+
+
+# labels of \gate{...} that are gates in the standard library, keyed by label without spaces or braces
+TEX_GATES = {
+    'X': 'x',
+    'Y': 'y',
+    'Z': 'z',
+    'S': 's',
+    'S^\\dagger': 'sdg',
+    'S^\\dag': 'sdg',
+    'H': 'h'
+}
+
+# commands that only decorate a cell: wire labels, vertical wires, spacing
+DECORATIONS = [
+    'qwx',
+    'cwx',
+    'lstick',
+    'rstick',
+    'push',
+    'ket',
+    'bra'
+]
+
+SPECIAL = re.compile(r'\\\\|\\.|[{}&]', re.DOTALL)
+
+
+def _read_group(tex, i):
+    """
+    Reads the brace delimited group starting at tex[i].
+
+    :param tex: The LaTeX source.
+    :param i: The index of the opening brace.
+    :raises: ValueError
+    :return: The contents of the group and the index after its closing brace.
+    """
+    depth = 0
+    for j in range(i, len(tex)):
+        if tex[j] == '{' and tex[j - 1] != '\\':
+            depth += 1
+        elif tex[j] == '}' and tex[j - 1] != '\\':
+            depth -= 1
+            if depth == 0:
+                return tex[i + 1:j], j + 1
+    raise ValueError(f'Unbalanced braces from position {i}.')
+
+
+def _split_top_level(tex, separator):
+    """
+    Splits LaTeX on a separator wherever it is not nested in braces.
+
+    :param tex: The LaTeX to split.
+    :param separator: The separator, e.g. '&' or '\\\\'.
+    :return: The parts.
+    """
+    parts = []
+    depth = 0
+    start = 0
+    # only braces, separators and escaped characters (so \{ and \& do not count) need looking at
+    for match in SPECIAL.finditer(tex):
+        token = match.group()
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+        elif token == separator and depth == 0:
+            parts.append(tex[start:match.start()])
+            start = match.end()
+    parts.append(tex[start:])
+    return parts
+
+
+def find_qcircuits(tex):
+    """
+    Finds the bodies of the \\Qcircuit environments in a LaTeX document.
+
+    :param tex: The LaTeX source.
+    :return: The body of every \\Qcircuit, in document order.
+    """
+    bodies = []
+    for match in re.finditer(r'\\Qcircuit\b[^{]*', tex):
+        body, end = _read_group(tex, match.end())
+        bodies.append(body)
+    return bodies
+
+
+def parse_cell(cell):
+    """
+    Reads the operation in one cell of a \\Qcircuit.
+
+    :param cell: The LaTeX between two &s.
+    :raises: ValueError
+    :return: One of ('gate', label), ('ctrl', offset), ('targ', None), ('meter', None) or None for a wire.
+    """
+    op = None
+    skip_until = 0
+    for match in re.finditer(r'\\([a-zA-Z]+)\s*(\[[^\]]*\])?', cell):
+        # commands inside an argument, e.g. the \dagger of \gate{S^\dagger}, are read with it
+        if match.start() < skip_until:
+            continue
+        command = match.group(1)
+        arg = None
+        skip_until = match.end()
+        if skip_until < len(cell) and cell[skip_until] == '{':
+            arg, skip_until = _read_group(cell, skip_until)
+
+        if command in DECORATIONS or command in ['qw', 'cw']:
+            continue
+        if op is not None:
+            raise ValueError(f'More than one operation in cell "{cell.strip()}".')
+        if command == 'gate':
+            op = ('gate', arg)
+        elif command == 'ctrl':
+            op = ('ctrl', int(arg))
+        elif command == 'targ':
+            op = ('targ', None)
+        elif command == 'meter':
+            op = ('meter', None)
+        else:
+            raise ValueError(f'Unsupported qcircuit command \\{command}.')
+    return op
+
+
+def _gate_name(label):
+    """
+    Maps a \\gate{...} label to a Builder method, or to a custom gate name.
+    """
+    label = label.replace(' ', '').replace('{', '').replace('}', '').strip('$')
+    if label in TEX_GATES:
+        return TEX_GATES[label], False
+    return re.sub(r'[^a-zA-Z0-9_]', '', label).lower(), True
+
+
+def tex_to_builder(body):
+    """
+    Reads the body of a \\Qcircuit into a Builder, column by column and top to bottom within a
+    column, the order test_data_generation.build_qasm writes them in.
+
+    Controls are followed along their offsets (through other controls, for multiply controlled
+    gates) to the \\targ they act on. \\qw and empty cells are identities.
+
+    :param body: The LaTeX between the braces of \\Qcircuit.
+    :raises: ValueError
+    :return: The Builder holding the QASM.
+    """
+    rows = [row for row in _split_top_level(body, '\\\\') if row.strip()]
+    grid = [[parse_cell(cell) for cell in _split_top_level(row, '&')] for row in rows]
+    builder = Builder(num_qubits=len(grid))
+
+    for column in range(max(len(row) for row in grid)):
+        ops = [row[column] if column < len(row) else None for row in grid]
+
+        controls = {}
+        for wire, op in enumerate(ops):
+            if op is None or op[0] != 'ctrl':
+                continue
+            target = wire
+            followed = set()
+            while 0 <= target < len(ops) and ops[target] is not None and ops[target][0] == 'ctrl' \
+                    and target not in followed:
+                followed.add(target)
+                target += ops[target][1]
+            if not (0 <= target < len(ops)) or ops[target] is None or ops[target][0] != 'targ':
+                raise ValueError(f'The control on wire {wire} in column {column} does not reach a \\targ.')
+            controls.setdefault(target, []).append(wire)
+
+        for wire, op in enumerate(ops):
+            if op is None:
+                builder.I(wire, qasm_only=True)
+            elif op[0] == 'gate':
+                name, custom = _gate_name(op[1])
+                if custom:
+                    builder.custom_gate(name, wire, qasm_only=True)
+                else:
+                    getattr(builder, name)(wire, qasm_only=True)
+            elif op[0] == 'meter':
+                builder.m(wire)
+            elif op[0] in ['ctrl', 'targ']:
+                target = wire if op[0] == 'targ' else next(t for t, c in controls.items() if wire in c)
+                sources = controls.get(target, [])
+                # multi-qubit gates are written once, at their topmost wire
+                if wire != min(sources + [target]):
+                    continue
+                if len(sources) == 0:
+                    builder.x(target, qasm_only=True)
+                elif len(sources) == 1:
+                    builder.cx(sources[0], target)
+                elif len(sources) == 2:
+                    builder.ccx(sources[0], sources[1], target)
+                else:
+                    raise ValueError(f'Unsupported gate with {len(sources)} controls in column {column}.')
+    return builder
+
+
+def parse_tex(path_to_tex):
+    """
+    Parses the first \\Qcircuit of a LaTeX file and returns QASM, without compiling it.
+
+    :param path_to_tex: The path to the LaTeX of the circuit.
+    :raises: ValueError
+    :return: The QASM.
+    """
+    with open(path_to_tex, 'r') as f:
+        bodies = find_qcircuits(f.read())
+    if len(bodies) == 0:
+        raise ValueError(f'No \\Qcircuit found in {path_to_tex}.')
+    return tex_to_builder(bodies[0]).program
+
+
+def parse_source(path_to_pdf, path_to_tex=None, **kwargs):
+    """
+    Returns the QASM of a circuit from its LaTeX source when there is one, falling back to
+    parse_circuit on the pdf when there is not or when the source cannot be read.
+
+    :param path_to_pdf: The path to the pdf of the circuit.
+    :param path_to_tex: The path to its LaTeX, defaults to the .tex next to the pdf.
+    :param kwargs: Passed on to parse_circuit.
+    :return: The QASM.
+    """
+    if path_to_tex is None:
+        path_to_tex = os.path.splitext(path_to_pdf)[0] + '.tex'
+    if os.path.exists(path_to_tex):
+        try:
+            return parse_tex(path_to_tex)
+        except ValueError as e:
+            print(f"Falling back to the pdf: {e}")
+    return parse_circuit(path_to_pdf, **kwargs)
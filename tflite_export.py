@@ -0,0 +1,255 @@
+import tensorflow as tf
+import numpy as np
+import getopt
+import pathlib
+import random
+import json
+import time
+import sys
+import os
+
+from images import load_image
+
+
+QUANTIZATIONS = [
+    'none',
+    'dynamic',
+    'float16',
+    'int8'
+]
+
+HELP_STRING = "Usage: python tflite_export.py --model saved_models/trained_model " \
+              "[--quantization none,dynamic,float16,int8] [--data_dir examples/gen] " \
+              "[--output_dir .] [--max_images 200] [--class_map equivalence_classes.json]"
+
+
+def representative_dataset(data_dir='examples/gen', num_samples=100, seed=123):
+    """
+    Builds a representative dataset generator for full integer quantization
+    from a seeded sample of the generated circuit images.
+
+    :param data_dir: The folder holding one sub-folder of images per circuit.
+    :param num_samples: The number of images to calibrate with.
+    :param seed: The seed used to sample the images.
+    :return: A generator function yielding single image batches.
+    """
+    images = sorted(str(path) for path in pathlib.Path(data_dir).glob('*/*.jpg'))
+    random.Random(seed).shuffle(images)
+    images = images[:num_samples]
+
+    def generator():
+        for image_path in images:
+            yield [load_image(image_path)[None, :, :]]
+
+    return generator
+
+
+def make_converter(model):
+    """
+    Creates a TFLite converter for a Keras model or the path to a saved model.
+
+    :param model: The Keras model or saved model directory.
+    :return: The converter.
+    """
+    if isinstance(model, (str, pathlib.Path)):
+        return tf.lite.TFLiteConverter.from_saved_model(str(model))
+    return tf.lite.TFLiteConverter.from_keras_model(model)
+
+
+def convert(model, quantization='none', data_dir='examples/gen', num_samples=100):
+    """
+    Converts the model to a TFLite flatbuffer with the requested post-training quantization.
+
+    :param model: The Keras model or saved model directory.
+    :param quantization: One of QUANTIZATIONS.
+    :param data_dir: The folder to draw the int8 representative dataset from.
+    :param num_samples: The number of representative images for int8 calibration.
+    :raises: ValueError
+    :return: The serialized TFLite model.
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f'Unsupported quantization {quantization}, expected one of {QUANTIZATIONS}.')
+
+    converter = make_converter(model)
+
+    if quantization == 'dynamic':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset(data_dir, num_samples)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        # pixels are already 0-255 so a uint8 input quantizes losslessly
+        converter.inference_input_type = tf.uint8
+
+    return converter.convert()
+
+
+def variant_path(quantization, folder='.'):
+    """
+    Returns the file name of an exported model variant.
+
+    :param quantization: One of QUANTIZATIONS.
+    :param folder: The folder holding the exported models.
+    :return: The path to the variant.
+    """
+    if quantization == 'none':
+        return os.path.join(folder, 'model.tflite')
+    return os.path.join(folder, f'model_{quantization}.tflite')
+
+
+def export_variants(model, quantizations=None, folder='.', data_dir='examples/gen'):
+    """
+    Writes a TFLite model for each of the requested quantizations.
+
+    :param model: The Keras model or saved model directory.
+    :param quantizations: The quantizations to export, defaults to all QUANTIZATIONS.
+    :param folder: The folder to write the models to.
+    :param data_dir: The folder to draw the int8 representative dataset from.
+    :return: A dict of quantization to exported model path.
+    """
+    paths = {}
+    for quantization in quantizations or QUANTIZATIONS:
+        print(f"exporting {quantization} ({variant_path(quantization, folder)})")
+        tflite_model = convert(model, quantization, data_dir)
+        paths[quantization] = variant_path(quantization, folder)
+        with open(paths[quantization], 'wb') as f:
+            f.write(tflite_model)
+    return paths
+
+
+def prepare_input(input_details, image):
+    """
+    Casts or quantizes a float image batch to the interpreter's input type.
+
+    :param input_details: The interpreter's details for the input tensor.
+    :param image: The float image batch.
+    :return: The input tensor value.
+    """
+    image = np.asarray(image, dtype=np.float32)
+    if input_details['dtype'] == np.float32:
+        return image
+    scale, zero_point = input_details['quantization']
+    if scale:
+        image = image / scale + zero_point
+    info = np.iinfo(input_details['dtype'])
+    return np.clip(np.round(image), info.min, info.max).astype(input_details['dtype'])
+
+
+def evaluate_variant(model_path, dataset, max_images=200):
+    """
+    Measures the size, single image latency and top-1 accuracy of an exported model.
+
+    :param model_path: The path to the TFLite model.
+    :param dataset: Batches of (images, labels) to evaluate on.
+    :param max_images: The maximum number of images to evaluate.
+    :return: A dict of metrics.
+    """
+    interpreter = tf.lite.Interpreter(model_path=model_path)
+    interpreter.allocate_tensors()
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+
+    latencies = []
+    correct = 0
+    for images, labels in dataset.unbatch().take(max_images):
+        value = prepare_input(input_details, images[None, :, :])
+        start = time.perf_counter()
+        interpreter.set_tensor(input_details['index'], value)
+        interpreter.invoke()
+        output = interpreter.get_tensor(output_details['index'])
+        latencies.append(time.perf_counter() - start)
+        if int(np.argmax(output)) == int(labels):
+            correct += 1
+
+    latencies = np.array(latencies) * 1000
+    return {
+        'path': model_path,
+        'size_bytes': os.path.getsize(model_path),
+        'images': len(latencies),
+        'latency_ms_mean': float(np.mean(latencies)) if len(latencies) else None,
+        'latency_ms_p50': float(np.percentile(latencies, 50)) if len(latencies) else None,
+        'latency_ms_p95': float(np.percentile(latencies, 95)) if len(latencies) else None,
+        'top1_accuracy': correct / len(latencies) if len(latencies) else None
+    }
+
+
+def export_report(model, dataset, quantizations=None, folder='.', data_dir='examples/gen',
+                  max_images=200, report_path='tflite_report.json'):
+    """
+    Exports every quantization variant and writes a report comparing them.
+
+    :param model: The Keras model or saved model directory.
+    :param dataset: Batches of (images, labels) to evaluate on.
+    :param quantizations: The quantizations to export, defaults to all QUANTIZATIONS.
+    :param folder: The folder to write the models and report to.
+    :param data_dir: The folder to draw the int8 representative dataset from.
+    :param max_images: The maximum number of images to evaluate each variant on.
+    :param report_path: The name of the JSON report.
+    :return: A dict of quantization to metrics.
+    """
+    paths = export_variants(model, quantizations, folder, data_dir)
+    report = {}
+    for quantization, path in paths.items():
+        report[quantization] = evaluate_variant(path, dataset, max_images)
+
+    print(f"\n{'variant':<10}{'size (MB)':>12}{'latency (ms)':>16}{'top-1':>10}")
+    for quantization, metrics in report.items():
+        print(f"{quantization:<10}{metrics['size_bytes'] / 2 ** 20:>12.2f}"
+              f"{metrics['latency_ms_mean'] or 0:>16.2f}{metrics['top1_accuracy'] or 0:>10.3f}")
+
+    with open(os.path.join(folder, report_path), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    return report
+
+
+def main(argv):
+    model = 'saved_models/trained_model'
+    quantizations = None
+    data_dir = 'examples/gen'
+    output_dir = '.'
+    max_images = 200
+    class_map = None
+
+    try:
+        opts, args = getopt.getopt(
+            argv,
+            "h",
+            ["help", "model=", "quantization=", "data_dir=", "output_dir=", "max_images=", "class_map="]
+        )
+    except getopt.GetoptError:
+        print(HELP_STRING)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ["-h", "--help"]:
+            print(HELP_STRING)
+            sys.exit()
+        elif opt == "--model":
+            model = arg
+        elif opt == "--quantization":
+            quantizations = arg.split(',')
+        elif opt == "--data_dir":
+            data_dir = arg
+        elif opt == "--output_dir":
+            output_dir = arg
+        elif opt == "--max_images":
+            max_images = int(arg)
+        elif opt == "--class_map":
+            with open(arg, 'r') as f:
+                class_map = json.load(f)
+
+    # image_classification imports this module for export_report
+    from image_classification import load_datasets
+
+    # the same labels and held out images the model was trained against
+    _, val_ds, _, _ = load_datasets(data_dir, 32, class_map=class_map)
+
+    export_report(model, val_ds, quantizations, output_dir, data_dir, max_images)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -6,14 +6,21 @@ import json
 import matplotlib.pyplot as plt
 import os
 
+from tflite_export import prepare_input
+from inference_bundle import DEFAULT_BUNDLE_PATH, class_circuits, load_bundle
+from images import load_image
+from result_cache import content_key, shared_cache
+
+# grid_model and cascade_model pull in the PDF parser, so they are imported by the branches that use them
+
 
 class ModelNotFoundException(BaseException):
     pass
 
 
-def get_saved_model():
+def get_saved_model(model_path='model.tflite'):
     try:
-        interpreter = tf.lite.Interpreter(model_path='model.tflite')
+        interpreter = tf.lite.Interpreter(model_path=model_path)
         classify_lite = interpreter.get_signature_runner('serving_default')
         return classify_lite
     except OSError as e:
@@ -21,12 +28,8 @@ def get_saved_model():
 
 
 def preprocess_image(image_path):
-    # read an image file
-    image = tf.io.read_file(image_path)
-    # turn image into numerical tensors with RGB
-    image = tf.image.decode_jpeg(image, channels=3)
-    # resize image
-    image = tf.image.resize(image, size=[400, 600])
+    # read an image file as RGB at the size the models take
+    image = load_image(image_path)
 
     # uncomment for debugging
     # plt.figure(figsize=(10, 10))
@@ -38,17 +41,23 @@ def preprocess_image(image_path):
     return image[None, :, :]  # Create a batch
 
 
-HELP_STRING = "Usage: python tool.py --input_file /path/to/circuit.jpg"
+HELP_STRING = "Usage: python tool.py --input_file /path/to/circuit.jpg " \
+              "[--model_file model_int8.tflite] [--bundle inference.bundle] [--grid] [--cascade] [--no_cache]"
 
 
 def main(argv):
     input_file = 'examples/gen/0/circuit_0.jpg'
+    model_file = 'model.tflite'
+    grid = False
+    cascade = False
+    bundle_file = None
+    use_cache = True
 
     try:
         opts, args = getopt.getopt(
             argv,
             "i",
-            ["input_file="]
+            ["input_file=", "model_file=", "bundle=", "grid", "cascade", "no_cache"]
         )
     except getopt.GetoptError:
         print(HELP_STRING)
@@ -61,25 +70,110 @@ def main(argv):
             sys.exit()
         elif opt in ["-i", "--input_file"]:
             input_file = arg
-
-    if input_file is not None:
+        elif opt == "--model_file":
+            model_file = arg
+        elif opt == "--bundle":
+            bundle_file = arg
+        elif opt == "--grid":
+            grid = True
+        elif opt == "--cascade":
+            cascade = True
+        elif opt == "--no_cache":
+            use_cache = False
+
+    if grid and model_file == 'model.tflite':
+        model_file = 'grid_model.tflite'
+    if cascade and model_file == 'model.tflite':
+        from cascade_model import DEFAULT_FOLDER
+        model_file = DEFAULT_FOLDER
+    # the bundle next to the package is preferred to a model.tflite in the working directory
+    if not grid and not cascade and model_file == 'model.tflite' and bundle_file is None \
+            and os.path.exists(DEFAULT_BUNDLE_PATH):
+        bundle_file = DEFAULT_BUNDLE_PATH
+    # the cascade is a folder of models, described and versioned by its cascade.json
+    version_file = os.path.join(model_file, 'cascade.json') if cascade else bundle_file or model_file
+
+    # a missing model is reported by get_saved_model below
+    cache = shared_cache() if use_cache and input_file is not None and os.path.exists(version_file) else None
+    if cache is not None:
+        # the model file's digest is its version, so a retrained or re-quantized model misses
+        kind = 'cascade' if cascade else 'grid' if grid else 'classes'
+        options = [kind]
+        class_names_path = os.path.join(os.path.dirname(os.path.abspath(model_file)), 'class_names.json')
+        if kind == 'classes' and bundle_file is None and os.path.exists(class_names_path):
+            # the labels come from class_names.json, which can change without the model
+            options.append(cache.file_digest(class_names_path))
+        key = content_key(input_file, cache.file_digest(version_file), *options)
+        result = cache.get(key)
+        if result is not None:
+            print('\x1b[34m Converting to QASM (cached): \n \x1b[37m')
+            result = json.loads(result)
+            print(result['qasm'] + "\n")
+            if result['confidence'] is not None:
+                print(f"confidence: {result['confidence']} %")
+            return
+
+    if input_file is not None and cascade:
+        print('\x1b[34m Opening the provided image... \n \x1b[37m')
+        img = preprocess_image(input_file)
+        print('\x1b[34m Loading the cascade... \n \x1b[37m')
+        from cascade_model import Cascade
+        try:
+            model = Cascade(model_file)
+        except (OSError, ValueError) as e:
+            raise ModelNotFoundException(str(e))
+        print('\x1b[34m Classifying the structure, then the gates: \n \x1b[37m')
+        prediction = model.predict(img)
+        print(prediction['qasm'] + "\n")
+        confidence = 100 * prediction['confidence']
+        print(f"confidence: {confidence} %")
+        print(f"structure: {prediction['structure_ms']:.2f} ms, gates: {prediction['head_ms']:.2f} ms")
+        if cache is not None:
+            cache.put(key, json.dumps({'qasm': prediction['qasm'], 'confidence': confidence}))
+    elif input_file is not None and grid:
+        print('\x1b[34m Opening the provided image... \n \x1b[37m')
+        img = preprocess_image(input_file)
+        print('\x1b[34m Loading the gate grid model... \n \x1b[37m')
+        model = get_saved_model(model_file)
+        print('\x1b[34m Decoding the gate grid to QASM: \n \x1b[37m')
+        from grid_model import predict_qasm
+        qasm = predict_qasm(model, img)
+        print(qasm + "\n")
+        if cache is not None:
+            cache.put(key, json.dumps({'qasm': qasm, 'confidence': None}))
+    elif input_file is not None:
         print('\x1b[34m Opening the provided image... \n \x1b[37m')
         img = preprocess_image(input_file)
         print('\x1b[34m Loading the circuit identification model... \n \x1b[37m')
-        model = get_saved_model()
+        if bundle_file is not None:
+            try:
+                bundle = load_bundle(bundle_file)
+            except (OSError, ValueError) as e:
+                raise ModelNotFoundException(str(e))
+            model = bundle.classify
+        else:
+            model = get_saved_model(model_file)
         print('\x1b[34m Classifying the quantum circuit... \n \x1b[37m')
-        predictions = model(rescaling_input=img)['dense_1']
+        # the signature has a single input and output, whatever Keras named them
+        input_name, input_details = next(iter(model.get_input_details().items()))
+        # quantized models may take integer inputs
+        img = prepare_input(input_details, img)
+        predictions = next(iter(model(**{input_name: img}).values()))
         print('\x1b[34m Converting to QASM: \n \x1b[37m')
-        dir_path = os.path.dirname(os.path.realpath(__file__))
-        # while its a 1-1 mapping it isn’t exactly in-order numerically, rather its alphanumerically.
-        sorted_ints = map(lambda j: int(j), sorted([str(i) for i in range(6000)]))
-        class_map = {}
-        for k, nt in enumerate(sorted_ints):
-            class_map[str(k)] = nt
-        qasm = open(f'{dir_path}/examples/gen/circuit_{list(class_map.keys())[list(class_map.values()).index(np.argmax(tf.nn.softmax(predictions)))]}.qasm')
-        print(qasm.read() + "\n")
-        print(f"confidence: {100 * np.max(tf.nn.softmax(predictions))} %")
-        qasm.close()
+        label = int(np.argmax(predictions))
+        if bundle_file is not None:
+            program = bundle.qasm(label)
+        else:
+            dir_path = os.path.dirname(os.path.realpath(__file__))
+            # training writes the circuit behind each output, which may be merged with equivalent circuits
+            circuit = class_circuits(model_file)[label]
+            with open(f'{dir_path}/examples/gen/circuit_{circuit}.qasm') as qasm:
+                program = qasm.read()
+        confidence = float(100 * np.max(tf.nn.softmax(predictions)))
+        print(program + "\n")
+        print(f"confidence: {confidence} %")
+        if cache is not None:
+            cache.put(key, json.dumps({'qasm': program, 'confidence': confidence}))
     else:
         print("The input file is a required parameter.")
 
@@ -0,0 +1,219 @@
+import numpy as np
+import contextlib
+import getopt
+import json
+import time
+import sys
+import io
+
+from qasm_utils import qasm_instructions
+from test_data_generation import enumerate_circuits
+
+
+GATE_MATRICES = {
+    'I': np.eye(2, dtype=complex),
+    'x': np.array([[0, 1], [1, 0]], dtype=complex),
+    'y': np.array([[0, -1j], [1j, 0]], dtype=complex),
+    'z': np.array([[1, 0], [0, -1]], dtype=complex),
+    's': np.array([[1, 0], [0, 1j]], dtype=complex),
+    'sdg': np.array([[1, 0], [0, -1j]], dtype=complex),
+    'h': np.array([[1, 1], [1, -1]], dtype=complex) / np.sqrt(2)
+}
+
+CONTROLLED_GATES = {
+    'cx': 1,
+    'ccx': 2
+}
+
+HELP_STRING = "Usage: python unitary.py [--max_depth 4] [--qubits 2] [--output equivalence_classes.json]"
+
+
+def operator(name, qubits, num_qubits):
+    """
+    Builds the unitary of one instruction on the whole register, with q[0] the most significant qubit.
+
+    :param name: The gate, one of GATES or ccx.
+    :param qubits: The qubits it acts on, controls first.
+    :param num_qubits: The size of the register.
+    :raises: ValueError
+    :return: The (2 ** num_qubits, 2 ** num_qubits) matrix.
+    """
+    if name in GATE_MATRICES:
+        matrix = np.ones((1, 1), dtype=complex)
+        for qubit in range(num_qubits):
+            matrix = np.kron(matrix, GATE_MATRICES[name] if qubit == qubits[0] else GATE_MATRICES['I'])
+        return matrix
+
+    if name in CONTROLLED_GATES and len(qubits) == CONTROLLED_GATES[name] + 1:
+        # a permutation flipping the target bit of every basis state whose control bits are all set
+        states = np.arange(2 ** num_qubits)
+        bits = [(states >> (num_qubits - 1 - qubit)) & 1 for qubit in qubits]
+        controlled = np.all(bits[:-1], axis=0)
+        flipped = np.where(controlled, states ^ (1 << (num_qubits - 1 - qubits[-1])), states)
+        matrix = np.zeros((2 ** num_qubits, 2 ** num_qubits), dtype=complex)
+        matrix[flipped, states] = 1
+        return matrix
+
+    raise ValueError(f'Cannot simulate {name} on {qubits}.')
+
+
+def grid_instructions(circuit):
+    """
+    Lists the instructions of a circuit grid in the order test_data_generation.build_qasm writes them.
+
+    :param circuit: The circuit as a list of wires, each a list of Gates.
+    :return: A list of (name, qubits).
+    """
+    instructions = []
+    for i in range(max(len(wire) for wire in circuit)):
+        seen_cxs = []
+        for w, wire in enumerate(circuit):
+            if i >= len(wire) or wire[i]['name'] == 'I':
+                continue
+            gate = wire[i]
+            if gate['name'] != 'cx':
+                instructions.append((gate['name'], (w,)))
+            elif (gate['source'], gate['target']) not in seen_cxs:
+                seen_cxs.append((gate['source'], gate['target']))
+                instructions.append(('cx', (gate['source'], gate['target'])))
+    return instructions
+
+
+def unitaries(programs, num_qubits=None):
+    """
+    Simulates a batch of circuits at once.
+
+    Every distinct instruction is turned into a matrix once; the batch is then a stack of
+    unitaries multiplied by the stacked matrices of its k-th instructions, one matmul per step.
+
+    :param programs: The circuits, each a list of (name, qubits).
+    :param num_qubits: The size of the register, defaults to the widest circuit.
+    :raises: ValueError
+    :return: The (len(programs), 2 ** num_qubits, 2 ** num_qubits) unitaries.
+    """
+    if num_qubits is None:
+        num_qubits = 1 + max([qubit for program in programs for name, qubits in program for qubit in qubits],
+                             default=0)
+    dimension = 2 ** num_qubits
+
+    # the identity pads the shorter circuits
+    table = [np.eye(dimension, dtype=complex)]
+    ids = {}
+    steps = np.zeros((len(programs), max([len(program) for program in programs], default=0)), dtype=np.int64)
+    for b, program in enumerate(programs):
+        for k, instruction in enumerate(program):
+            if instruction not in ids:
+                ids[instruction] = len(table)
+                table.append(operator(instruction[0], instruction[1], num_qubits))
+            steps[b, k] = ids[instruction]
+    table = np.stack(table)
+
+    result = np.broadcast_to(table[0], (len(programs), dimension, dimension)).copy()
+    for k in range(steps.shape[1]):
+        result = np.matmul(table[steps[:, k]], result)
+    return result
+
+
+def same_unitary(u, v, atol=1e-6):
+    """
+    Compares unitaries up to a global phase: |tr(U^dagger V)| reaches its maximum, the
+    dimension, only when V = exp(i phi) U.
+
+    :param u: A unitary or stack of unitaries.
+    :param v: Unitaries of the same shape.
+    :param atol: The tolerance.
+    :return: Whether each pair is equivalent.
+    """
+    dimension = u.shape[-1]
+    overlap = np.abs(np.einsum('...ij,...ij->...', np.conj(u), v)) / dimension
+    return np.abs(overlap - 1) < atol
+
+
+def functional_accuracy(qasms, references):
+    """
+    The fraction of QASM programs that implement the same unitary as their reference.
+
+    :param qasms: The predicted or parsed QASM.
+    :param references: The expected QASM.
+    :return: The accuracy.
+    """
+    programs = [qasm_instructions(qasm) for qasm in qasms]
+    expected = [qasm_instructions(reference) for reference in references]
+    num_qubits = 1 + max([qubit for program in programs + expected for name, qubits in program for qubit in qubits],
+                         default=0)
+    return float(np.mean(same_unitary(unitaries(programs, num_qubits), unitaries(expected, num_qubits))))
+
+
+def equivalence_classes(stack, decimals=6):
+    """
+    Groups unitaries that are equal up to a global phase.
+
+    Each unitary is rotated so that its first non-zero entry is real and positive and
+    rounded, which makes equivalent unitaries identical rows to np.unique.
+
+    :param stack: The (n, d, d) unitaries.
+    :param decimals: The decimals to round to before comparing.
+    :return: The class label of every unitary and the index of the first unitary of every class.
+    """
+    flat = stack.reshape(len(stack), -1)
+    pivot = flat[np.arange(len(flat)), np.argmax(np.abs(flat) > 10 ** -decimals, axis=1)]
+    canonical = np.round(flat * (np.abs(pivot) / pivot)[:, None], decimals)
+    # adding zero turns -0. into 0. so they compare equal
+    keys = np.concatenate([canonical.real, canonical.imag], axis=1) + 0.
+    _, representatives, labels = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    return labels.reshape(-1), representatives
+
+
+def class_map(circuits):
+    """
+    Maps every circuit to the first circuit implementing the same unitary, to merge classes
+    or dedupe a dataset enumerated by enumerate_circuits.
+
+    :param circuits: The circuits, each a list of wires holding a list of Gates.
+    :return: A dict of circuit number to the number of its representative.
+    """
+    labels, representatives = equivalence_classes(unitaries(
+        [grid_instructions(circuit) for circuit in circuits], max(len(circuit) for circuit in circuits)
+    ))
+    return {num: int(representatives[label]) for num, label in enumerate(labels)}
+
+
+def main(argv):
+    max_depth = 4
+    qubits = 2
+    output = 'equivalence_classes.json'
+
+    try:
+        opts, args = getopt.getopt(argv, "h", ["help", "max_depth=", "qubits=", "output="])
+    except getopt.GetoptError:
+        print(HELP_STRING)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ["-h", "--help"]:
+            print(HELP_STRING)
+            sys.exit()
+        elif opt == "--max_depth":
+            max_depth = int(arg)
+        elif opt == "--qubits":
+            qubits = int(arg)
+        elif opt == "--output":
+            output = arg
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        circuits = enumerate_circuits(max_depth, qubits)
+
+    start = time.perf_counter()
+    mapping = class_map(circuits)
+    elapsed = time.perf_counter() - start
+
+    classes = len(set(mapping.values()))
+    print(f"{len(circuits)} circuits simulated in {elapsed:.3f}s ({len(circuits) / elapsed:.0f} circuits/sec)")
+    print(f"{classes} distinct unitaries, {len(circuits) - classes} circuits duplicate another")
+
+    with open(output, 'w') as f:
+        json.dump({str(num): str(representative) for num, representative in mapping.items()}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])